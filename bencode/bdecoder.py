@@ -6,26 +6,11 @@ def decode(string, level = -2):
 
 def _decode(string, index, level):
     try:
-        values = {
-            ord('i'): _decode_integer,
-            ord('l'): _decode_list,
-            ord('d'): _decode_dictionary,
-            ord('0'): _decode_string,
-            ord('1'): _decode_string,
-            ord('2'): _decode_string,
-            ord('3'): _decode_string,
-            ord('4'): _decode_string,
-            ord('5'): _decode_string,
-            ord('6'): _decode_string,
-            ord('7'): _decode_string,
-            ord('8'): _decode_string,
-            ord('9'): _decode_string
-        }
         if  -1 <= level <= 0:
-            decoded, end = values.get(string[index])(string, index, -2)
+            decoded, end = _DECODERS.get(string[index])(string, index, -2)
             return string[index:end], end
         else:
-            return values.get(string[index])(string, index, level - 1)
+            return _DECODERS.get(string[index])(string, index, level - 1)
     except TypeError:
         raise BencodeError("Unexpected character " + chr(string[index]) + 
                            " at " + str(index))
@@ -85,9 +70,161 @@ def _decode_dictionary(string, index, level):
     except IndexError:
         raise BencodeError("Invalid dictionary at " + str(index))
 
+_DECODERS = {
+    ord('i'): _decode_integer,
+    ord('l'): _decode_list,
+    ord('d'): _decode_dictionary,
+    ord('0'): _decode_string,
+    ord('1'): _decode_string,
+    ord('2'): _decode_string,
+    ord('3'): _decode_string,
+    ord('4'): _decode_string,
+    ord('5'): _decode_string,
+    ord('6'): _decode_string,
+    ord('7'): _decode_string,
+    ord('8'): _decode_string,
+    ord('9'): _decode_string
+}
+
+# Token types used by fast_decode, looked up by the first byte of
+# each value
+_INVALID = 0
+_STRING = 1
+_INTEGER = 2
+_LIST = 3
+_DICTIONARY = 4
+_END = 5
+
+def _create_token_table():
+    table = [_INVALID] * 256
+    for c in b'0123456789':
+        table[c] = _STRING
+
+    table[ord('i')] = _INTEGER
+    table[ord('l')] = _LIST
+    table[ord('d')] = _DICTIONARY
+    table[ord('e')] = _END
+
+    return tuple(table)
+
+_TOKENS = _create_token_table()
+
+# Decodes the same input as decode, but in a single pass without
+# recursion. Nested containers are kept on an explicit stack.
+def fast_decode(string):
+    if not isinstance(string, bytes):
+        string = bytes(string)
+
+    tokens = _TOKENS
+    length = len(string)
+
+    stack = []
+    container = None
+    in_dict = False
+    key = None
+    index = 0
+    token = _INVALID
+
+    try:
+        while True:
+            # Inside a dictionary every value is preceded by a string key
+            if in_dict and key is None and string[index] != ord('e'):
+                if tokens[string[index]] != _STRING:
+                    raise BencodeError("Invalid dictionary at " + \
+                                           str(index) + \
+                                           ", key must be a string")
+
+                token = _STRING
+                colon = string.index(b':', index)
+                start = colon + 1
+                index = start + int(string[index:colon])
+                key = string[start:index]
+
+            token = tokens[string[index]]
+
+            if token == _STRING:
+                colon = string.index(b':', index)
+                start = colon + 1
+                index = start + int(string[index:colon])
+                if index > length:
+                    raise BencodeError("Invalid string at " + str(colon))
+
+                value = string[start:index]
+            elif token == _INTEGER:
+                end = string.index(b'e', index)
+                value = int(string[index + 1:end])
+                index = end + 1
+            elif token == _DICTIONARY or token == _LIST:
+                stack.append((container, in_dict, key))
+                in_dict = token == _DICTIONARY
+                container = {} if in_dict else []
+                key = None
+                index += 1
+                continue
+            elif token == _END and not container is None:
+                if not key is None:
+                    raise BencodeError("Invalid dictionary at " + \
+                                           str(index) + ", missing value")
+
+                value = container
+                container, in_dict, key = stack.pop()
+                index += 1
+            else:
+                raise BencodeError("Unexpected character " + \
+                                       chr(string[index]) + " at " + str(index))
+
+            if container is None:
+                return value
+            elif in_dict:
+                container[key] = value
+                key = None
+            else:
+                container.append(value)
+    except ValueError:
+        if token == _INTEGER:
+            raise BencodeError("Invalid integer at " + str(index))
+
+        raise BencodeError("Invalid string at " + str(index))
+    except IndexError:
+        raise BencodeError("Unexpected end of string at " + str(index))
+
+def _benchmark(number_of_files = 100000, rounds = 3):
+    import time
+    from .bencoder import encode
+
+    files = [{'length': i, 'path': ['directory', 'file%d.dat' % i]} \
+                 for i in range(number_of_files)]
+    content = encode({
+        'announce': 'http://tracker/announce',
+        'info': {
+            'name': 'benchmark',
+            'piece length': 262144,
+            'pieces': b'\x00' * 20 * number_of_files,
+            'files': files
+        }
+    })
+
+    size = len(content) / (1024 * 1024)
+    print("Decoding %.1f MB, %d rounds" % (size, rounds))
+
+    for name, f in (('decode', decode), ('fast_decode', fast_decode)):
+        best = None
+        for r in range(rounds):
+            start = time.perf_counter()
+            f(content)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        print(" - %-20s %.3f s, %.1f MB/s" % (name, best, size / best))
+
 if __name__ == '__main__':
     print(decode(b'd4:sapmlee'))
     print(decode(b'd4:spamli34ei-3eee'))
 
     d = decode(b'd4:spamli23ei4e2:asd5:12345leee4:sponi345ee', 2)
     print(d)
+
+    print(fast_decode(b'd4:spamli34ei-3eee'))
+    print(fast_decode(b'd4:spamli23ei4e2:asd5:12345leee4:sponi345ee'))
+
+    _benchmark()
@@ -1,28 +1,77 @@
+import collections.abc
+
 from .bencode_error import BencodeError
 
+# Dictionary keys are always written in sorted order (compared as raw
+# byte strings), so equal objects are always encoded the same way.
+# Byte strings are handed to the output as they are, without being
+# copied into intermediate results.
+
 def encode(obj):
-    if isinstance(obj, str):
-        return str(len(obj)).encode('ASCII') + b':' + obj.encode('UTF-8')
-    elif isinstance(obj, bytes):
-        return str(len(obj)).encode('ASCII') + b':' + obj
-    elif isinstance(obj, list):
-        return b'l' + b''.join([encode(item) for item in obj]) + b'e'
-    elif isinstance(obj, dict):
-        enc = []
-
-        for key, value in obj.items():
-            if not (isinstance(key, str) or isinstance(key, bytes)):
-                raise BencodeError("Key in dictionary must be string")
-
-            enc.append(encode(key))
-            enc.append(encode(value))
-
-        return b'd' + b''.join(enc) + b'e'
+    chunks = []
+    _encode(obj, chunks.append)
+    return b''.join(chunks)
+
+# Encode obj into out, which can be any object with a write method
+# accepting bytes-like objects (a file, io.BytesIO, socket.makefile('wb')
+# etc.). Nothing is returned.
+def encode_to(obj, out):
+    _encode(obj, out.write)
+
+def _key(key):
+    if isinstance(key, str):
+        return key.encode('UTF-8')
+    elif isinstance(key, bytes):
+        return key
+    elif isinstance(key, (bytearray, memoryview)):
+        return bytes(key)
+
+    raise BencodeError("Key in dictionary must be string")
+
+def _encode(obj, write):
+    if isinstance(obj, bytes):
+        write(b'%d:' % len(obj))
+        write(obj)
+    elif isinstance(obj, str):
+        obj = obj.encode('UTF-8')
+        write(b'%d:' % len(obj))
+        write(obj)
+    elif isinstance(obj, (bytearray, memoryview)):
+        write(b'%d:' % memoryview(obj).nbytes)
+        write(obj)
     elif isinstance(obj, int):
-        return b'i' + str(obj).encode('ASCII') + b'e'
+        write(b'i%de' % obj)
+    elif isinstance(obj, collections.abc.Mapping):
+        items = sorted(((_key(key), value) for key, value in obj.items()), \
+                           key = lambda item: item[0])
+
+        write(b'd')
+        last = None
+        for key, value in items:
+            if key == last:
+                raise BencodeError("Duplicate key " + repr(key) + \
+                                       " in dictionary")
+            last = key
+
+            write(b'%d:' % len(key))
+            write(key)
+            _encode(value, write)
+        write(b'e')
+    elif isinstance(obj, (list, tuple, collections.abc.Sequence)):
+        write(b'l')
+        for item in obj:
+            _encode(item, write)
+        write(b'e')
     else:
-        raise BencodeError("Can't encode " + str(obj) + 
+        raise BencodeError("Can't encode " + str(obj) +
                            " of type " + obj.__class__.__name__)
 
 if __name__ == '__main__':
+    import io
+
     print(encode({'a':1, b'b': [1,2,3, 'as', b'haha go']}))
+    print(encode({b'b': 1, 'a': (memoryview(b'view'), bytearray(b'array'))}))
+
+    out = io.BytesIO()
+    encode_to({'z': 0, 'm': {'y': b'', 'x': []}}, out)
+    print(out.getvalue())
@@ -0,0 +1,313 @@
+import array
+import collections.abc
+
+from .bencode_error import BencodeError
+from .bdecoder import _TOKENS, _INVALID, _STRING, _INTEGER, _LIST, \
+    _DICTIONARY, _END
+
+# Lazy decoding. The input is scanned once and the type and byte span
+# of every value (dictionary keys included) is recorded in a flat
+# index. Lists and dictionaries are wrapped in LazyList and LazyDict,
+# which only decode the entries that are accessed. The original bytes
+# of any value can be retrieved without encoding it again, e.g.
+#
+#     meta = lazy.decode(content)
+#     info_hash = hashlib.sha1(meta.raw_of(b'info')).digest()
+#
+# An Index can also be made of one value within a larger input (see
+# schema.LAZY), it only keeps the bytes of that value. Containers give
+# their index and token, to walk the index directly.
+
+# Kinds of values, see Index.kind
+STRING = _STRING
+INTEGER = _INTEGER
+LIST = _LIST
+DICTIONARY = _DICTIONARY
+
+def decode(string):
+    return Index(string).value(0)
+
+class Index(object):
+    # Scans the value starting at start in string
+    def __init__(self, string, start = 0):
+        if not isinstance(string, bytes):
+            string = bytes(string)
+
+        # Per token: type, start of the encoded value, end of the
+        # encoded value and the token following the value (for
+        # containers the token after the closing 'e')
+        self._types = bytearray()
+        self._starts = array.array('q')
+        self._ends = array.array('q')
+        self._nexts = array.array('q')
+
+        end = self._scan(string, start)
+        if start != 0 or end != len(string):
+            string = string[start:end]
+
+        self._string = string
+        self._view = memoryview(string)
+
+    # Spans are recorded relative to start, returns the end of the value
+    def _scan(self, string, start):
+        tokens = _TOKENS
+        length = len(string)
+
+        types = self._types
+        starts = self._starts
+        ends = self._ends
+        nexts = self._nexts
+
+        types_append = types.append
+        starts_append = starts.append
+        ends_append = ends.append
+        nexts_append = nexts.append
+
+        # Open containers, with the state of their parent to go back to.
+        # Within a dictionary key is true when a key is expected next.
+        stack = []
+        in_dict = False
+        key = False
+        index = start
+        token = _INVALID
+
+        try:
+            while True:
+                token = tokens[string[index]]
+                t = len(types)
+
+                if token == _STRING:
+                    colon = string.index(b':', index)
+                    end = colon + 1 + int(string[index:colon])
+                    if end > length:
+                        raise BencodeError("Invalid string at " + str(colon))
+                elif token == _INTEGER:
+                    if key:
+                        raise BencodeError("Invalid dictionary at " + \
+                                               str(index) + \
+                                               ", key must be a string")
+
+                    end = string.index(b'e', index) + 1
+                    int(string[index + 1:end - 1])
+                elif token == _DICTIONARY or token == _LIST:
+                    if key:
+                        raise BencodeError("Invalid dictionary at " + \
+                                               str(index) + \
+                                               ", key must be a string")
+
+                    types_append(token)
+                    starts_append(index - start)
+                    ends_append(0)
+                    nexts_append(0)
+
+                    # A value in a dictionary is followed by a key
+                    stack.append((t, in_dict, in_dict))
+                    in_dict = key = token == _DICTIONARY
+                    index += 1
+                    continue
+                elif token == _END and stack:
+                    if in_dict and not key:
+                        raise BencodeError("Invalid dictionary at " + \
+                                               str(index) + ", missing value")
+
+                    t, in_dict, key = stack.pop()
+                    index += 1
+                    ends[t] = index - start
+                    nexts[t] = len(types)
+
+                    if not stack:
+                        return index
+
+                    continue
+                else:
+                    raise BencodeError("Unexpected character " + \
+                                           chr(string[index]) + \
+                                           " at " + str(index))
+
+                types_append(token)
+                starts_append(index - start)
+                ends_append(end - start)
+                nexts_append(t + 1)
+                index = end
+
+                if not stack:
+                    return index
+
+                if in_dict:
+                    key = not key
+        except ValueError:
+            if token == _INTEGER:
+                raise BencodeError("Invalid integer at " + str(index))
+
+            raise BencodeError("Invalid string at " + str(index))
+        except IndexError:
+            raise BencodeError("Unexpected end of string at " + str(index))
+
+    @property
+    def string(self):
+        return self._string
+
+    def __len__(self):
+        return len(self._types)
+
+    def kind(self, token):
+        return self._types[token]
+
+    def span(self, token):
+        return self._starts[token], self._ends[token]
+
+    def raw(self, token):
+        return self._view[self._starts[token]:self._ends[token]]
+
+    def next(self, token):
+        return self._nexts[token]
+
+    def children(self, token):
+        child = token + 1
+        end = self._nexts[token]
+        nexts = self._nexts
+
+        while child < end:
+            yield child
+            child = nexts[child]
+
+    def key(self, token):
+        start = self._string.index(b':', self._starts[token]) + 1
+        return self._string[start:self._ends[token]]
+
+    def value(self, token):
+        kind = self._types[token]
+        if kind == _STRING:
+            start = self._string.index(b':', self._starts[token]) + 1
+            return self._string[start:self._ends[token]]
+        elif kind == _INTEGER:
+            return int(self._string[self._starts[token] + 1:\
+                                        self._ends[token] - 1])
+        elif kind == _LIST:
+            return LazyList(self, token)
+        else:
+            return LazyDict(self, token)
+
+
+class _LazyContainer(object):
+    def __init__(self, index, token):
+        self._index = index
+        self._token = token
+
+    def __repr__(self):
+        return "<%s span=%s>" % (self.__class__.__name__, self.span)
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def token(self):
+        return self._token
+
+    @property
+    def span(self):
+        return self._index.span(self._token)
+
+    @property
+    def raw(self):
+        return self._index.raw(self._token)
+
+    def to_python(self):
+        from .bdecoder import fast_decode
+        return fast_decode(self.raw)
+
+    def span_of(self, key):
+        return self._index.span(self._value_token(key))
+
+    def raw_of(self, key):
+        return self._index.raw(self._value_token(key))
+
+
+class LazyDict(_LazyContainer, collections.abc.Mapping):
+    def __init__(self, index, token):
+        super(LazyDict, self).__init__(index, token)
+        self._keys = None
+
+    def _key_tokens(self):
+        if self._keys is None:
+            index = self._index
+            keys = {}
+
+            children = index.children(self._token)
+            for key in children:
+                keys[index.key(key)] = key
+
+                # Skip the value
+                next(children)
+
+            self._keys = keys
+
+        return self._keys
+
+    def _value_token(self, key):
+        if isinstance(key, str):
+            key = key.encode('UTF-8')
+
+        return self._key_tokens()[key] + 1
+
+    def __getitem__(self, key):
+        return self._index.value(self._value_token(key))
+
+    def __contains__(self, key):
+        if isinstance(key, str):
+            key = key.encode('UTF-8')
+
+        return key in self._key_tokens()
+
+    def __iter__(self):
+        return iter(self._key_tokens())
+
+    def __len__(self):
+        return len(self._key_tokens())
+
+    def key_span_of(self, key):
+        return self._index.span(self._value_token(key) - 1)
+
+
+class LazyList(_LazyContainer, collections.abc.Sequence):
+    def __init__(self, index, token):
+        super(LazyList, self).__init__(index, token)
+        self._items = None
+
+    def _item_tokens(self):
+        if self._items is None:
+            self._items = array.array('q', \
+                self._index.children(self._token))
+
+        return self._items
+
+    def _value_token(self, i):
+        return self._item_tokens()[i]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._index.value(t) for t in self._item_tokens()[i]]
+
+        return self._index.value(self._value_token(i))
+
+    def __iter__(self):
+        index = self._index
+        for t in index.children(self._token):
+            yield index.value(t)
+
+    def __len__(self):
+        return len(self._item_tokens())
+
+
+if __name__ == '__main__':
+    d = decode(b'd4:spamli23ei4e2:asd5:12345leee4:sponi345ee')
+    print(d)
+    print(list(d))
+    print(d[b'spam'], d[b'spam'].span, bytes(d.raw_of(b'spam')))
+    print(d.key_span_of(b'spon'), d.span_of(b'spon'), d[b'spon'])
+    print(d[b'spam'][2], d[b'spam'][3].to_python())
+    print(d.to_python())
+
+    i = Index(b'xxli1e2:abeyy', 2)
+    print(i.string, i.value(0)[1])
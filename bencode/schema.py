@@ -0,0 +1,234 @@
+from . import lazy
+from .bencode_error import BencodeError
+from .bdecoder import _decode, _TOKENS, _STRING, _INTEGER, _LIST, \
+    _DICTIONARY, _END
+
+# Schema directed decoding. A Record subclass lists the dictionary keys
+# it is interested in, and decode fills an instance of it straight from
+# the input. Values are checked against the declared types while
+# parsing, and keys which are not part of the schema are skipped
+# without being decoded.
+#
+#     class FileEntry(schema.Record):
+#         fields = (
+#             schema.Field('length', int),
+#             schema.Field('path', schema.List(str)),
+#             schema.Field('md5sum', bytes, None)
+#         )
+#
+#     entry = schema.decode(b'd6:lengthi5e4:pathl1:aee', FileEntry)
+#     entry.length, entry.path, entry.md5sum # 5, ['a'], None
+#
+# Supported field types are int, bytes, str (decoded as UTF-8), List of
+# another type, Record subclasses, ANY (decoded as by bdecoder.decode),
+# RAW (the encoded value as bytes) and LAZY (only scanned, lists and
+# dictionaries are lazy.LazyList and lazy.LazyDict).
+
+ANY = 'any'
+RAW = 'raw'
+LAZY = 'lazy'
+
+# Marks a field without a default, decoding fails if it is missing
+REQUIRED = object()
+
+class Field(object):
+    def __init__(self, key, type, default = REQUIRED, name = None):
+        if isinstance(key, bytes):
+            key = key.decode('UTF-8')
+
+        self.key = key.encode('UTF-8')
+        self.type = type
+        self.default = default
+        self.name = name or key.replace(' ', '_').replace('-', '_')
+
+class List(object):
+    def __init__(self, type):
+        self.type = type
+
+def decode(string, record):
+    try:
+        value, index = _parser(record)(string, 0)
+        return value
+    except IndexError:
+        raise BencodeError("Unexpected end of string")
+
+class Record(object):
+    fields = ()
+
+    def __repr__(self):
+        values = ', '.join(["%s=%r" % (f.name, getattr(self, f.name)) \
+                                for f in self.fields])
+        return "<%s %s>" % (self.__class__.__name__, values)
+
+    # Start and end of the dictionary the record was decoded from
+    @property
+    def span(self):
+        return self._span
+
+    @classmethod
+    def _compile(cls):
+        if not '_keys' in cls.__dict__:
+            cls._keys = dict((f.key, (f.name, _parser(f.type))) \
+                                 for f in cls.fields)
+
+        return cls._keys
+
+    @classmethod
+    def _parse(cls, string, index):
+        keys = cls._compile()
+        tokens = _TOKENS
+
+        if tokens[string[index]] != _DICTIONARY:
+            raise BencodeError("Expected dictionary at " + str(index))
+
+        record = cls.__new__(cls)
+        values = record.__dict__
+        start = index
+        index += 1
+
+        while string[index] != ord('e'):
+            if tokens[string[index]] != _STRING:
+                raise BencodeError("Invalid dictionary at " + str(index)
+                                   + ", key must be a string")
+
+            key, index = _parse_bytes(string, index)
+            field = keys.get(key)
+            if field is None:
+                index = _skip(string, index)
+            else:
+                name, parse = field
+                values[name], index = parse(string, index)
+
+        for f in cls.fields:
+            if not f.name in values:
+                if f.default is REQUIRED:
+                    raise BencodeError("Missing key " + \
+                        f.key.decode('UTF-8') + " in dictionary at " + \
+                                           str(start))
+
+                values[f.name] = f.default
+
+        record._span = (start, index + 1)
+        return record, index + 1
+
+def _parser(kind):
+    if kind is int:
+        return _parse_integer
+    elif kind is bytes:
+        return _parse_bytes
+    elif kind is str:
+        return _parse_str
+    elif kind is ANY:
+        return _parse_any
+    elif kind is RAW:
+        return _parse_raw
+    elif kind is LAZY:
+        return _parse_lazy
+    elif isinstance(kind, List):
+        item = _parser(kind.type)
+        return lambda string, index: _parse_list(string, index, item)
+    elif isinstance(kind, type) and issubclass(kind, Record):
+        return kind._parse
+
+    raise TypeError("Unsupported field type " + str(kind))
+
+def _parse_integer(string, index):
+    if string[index] != ord('i'):
+        raise BencodeError("Expected integer at " + str(index))
+
+    try:
+        end = string.index(b'e', index)
+        return int(string[index + 1:end]), end + 1
+    except ValueError:
+        raise BencodeError("Invalid integer at " + str(index))
+
+def _parse_bytes(string, index):
+    if _TOKENS[string[index]] != _STRING:
+        raise BencodeError("Expected string at " + str(index))
+
+    try:
+        colon = string.index(b':', index)
+        end = colon + 1 + int(string[index:colon])
+    except ValueError:
+        raise BencodeError("Invalid string at " + str(index))
+
+    if end > len(string):
+        raise BencodeError("Invalid string at " + str(index))
+
+    return string[colon + 1:end], end
+
+def _parse_str(string, index):
+    value, end = _parse_bytes(string, index)
+    try:
+        return value.decode('UTF-8'), end
+    except UnicodeDecodeError:
+        raise BencodeError("Invalid UTF-8 string at " + str(index))
+
+def _parse_any(string, index):
+    return _decode(string, index, -2)
+
+def _parse_raw(string, index):
+    end = _skip(string, index)
+    return string[index:end], end
+
+def _parse_lazy(string, index):
+    value = lazy.Index(string, index)
+    return value.value(0), index + len(value.string)
+
+def _parse_list(string, index, item):
+    if string[index] != ord('l'):
+        raise BencodeError("Expected list at " + str(index))
+
+    index += 1
+    result = []
+    while string[index] != ord('e'):
+        value, index = item(string, index)
+        result.append(value)
+
+    return result, index + 1
+
+# Returns the index following the value starting at index
+def _skip(string, index):
+    tokens = _TOKENS
+    depth = 0
+    start = index
+
+    try:
+        while True:
+            token = tokens[string[index]]
+            if token == _STRING:
+                colon = string.index(b':', index)
+                index = colon + 1 + int(string[index:colon])
+            elif token == _INTEGER:
+                index = string.index(b'e', index) + 1
+            elif token == _LIST or token == _DICTIONARY:
+                depth += 1
+                index += 1
+                continue
+            elif token == _END and depth:
+                depth -= 1
+                index += 1
+            else:
+                raise BencodeError("Unexpected character " + \
+                                       chr(string[index]) + " at " + str(index))
+
+            if depth == 0:
+                if index > len(string):
+                    break
+
+                return index
+    except ValueError:
+        pass
+
+    raise BencodeError("Invalid value at " + str(start))
+
+if __name__ == '__main__':
+    class FileEntry(Record):
+        fields = (
+            Field('length', int),
+            Field('path', List(str)),
+            Field('md5sum', bytes, None)
+        )
+
+    entry = decode(b'd6:lengthi5e5:extrad1:ai1ee4:pathl1:a1:bee', FileEntry)
+    print(entry, entry.span)
@@ -0,0 +1,268 @@
+import os
+import time
+import logging
+import threading
+import collections
+
+import filepool
+
+_logger = logging.getLogger('bittorrent.diskio')
+
+IO_WORKERS = 2
+
+# When written data is forced to disk: never (left to the OS), after
+# every batch of writes, or at most every SYNC_INTERVAL seconds
+SYNC_NONE = 'none'
+SYNC_ALWAYS = 'always'
+SYNC_PERIODIC = 'periodic'
+SYNC_INTERVAL = 30 #seconds
+
+# Most buffers written by one pwritev
+_IOV_MAX = 1024
+
+# Disk I/O on a pool of threads. Writes are queued with a completion
+# callback and done with positional writes, so the callers never wait
+# on the disk. Queued writes which are adjacent in the same file are
+# coalesced into one pwritev. Any other disk work (e.g. reading a
+# block) can be run on the I/O threads with call.
+class DiskIO(object):
+    def __init__(self, file_pool = None, workers = IO_WORKERS, \
+                     sync = SYNC_NONE, sync_interval = SYNC_INTERVAL):
+        if not sync in (SYNC_NONE, SYNC_ALWAYS, SYNC_PERIODIC):
+            raise ValueError("Unknown sync policy " + str(sync))
+
+        self._pool = filepool.pool if file_pool is None else file_pool
+        self._sync = sync
+        self._sync_interval = sync_interval
+
+        # Queued jobs: ('write', path) for all the writes queued for
+        # the file at path, or ('call', f, callback)
+        self._jobs = collections.deque()
+        # Path => queued writes ('write', path, offset, data, callback)
+        self._writes_queued = {}
+        self._queued = 0
+        self._ready = threading.Condition()
+        self._busy = 0
+        self._halt = False
+
+        # Paths written to since they were last synced
+        self._dirty = set()
+        self._synced = time.time()
+
+        self._writes = 0
+        self._coalesced = 0
+        self._written = 0
+        self._calls = 0
+        self._syncs = 0
+
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target = self._run)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    # Writes data at offset in the file at path. callback(error) is
+    # called on an I/O thread, error is None if the write succeeded.
+    def write(self, path, offset, data, callback = None):
+        with self._ready:
+            self._check_halt()
+
+            # Joins the writes already queued for the file, if any
+            writes = self._writes_queued.get(path, None)
+            if writes is None:
+                self._writes_queued[path] = \
+                    [('write', path, offset, data, callback)]
+                self._add(('write', path))
+            else:
+                writes.append(('write', path, offset, data, callback))
+                self._queued += 1
+
+    # Runs f on an I/O thread, then callback(result, error)
+    def call(self, f, callback = None):
+        with self._ready:
+            self._check_halt()
+            self._add(('call', f, callback))
+
+    def _check_halt(self):
+        if self._halt:
+            raise IOError("Disk I/O has been halted")
+
+    def _add(self, job):
+        self._jobs.append(job)
+        self._queued += 1
+        self._ready.notify()
+
+    # Waits until all queued jobs are done
+    def drain(self):
+        with self._ready:
+            while self._jobs or self._busy:
+                self._ready.wait()
+
+    def halt(self):
+        self.drain()
+        with self._ready:
+            self._halt = True
+            self._ready.notify_all()
+
+        if self._sync != SYNC_NONE:
+            self._sync_dirty()
+
+    def statistics(self):
+        with self._ready:
+            return {
+                'queued': self._queued,
+                'writes': self._writes,
+                'coalesced': self._coalesced,
+                'bytes written': self._written,
+                'calls': self._calls,
+                'syncs': self._syncs
+            }
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self._jobs and not self._halt:
+                    self._ready.wait()
+
+                if not self._jobs:
+                    return
+
+                job = self._jobs.popleft()
+                if job[0] == 'write':
+                    # All writes queued for the same file
+                    batch = self._writes_queued.pop(job[1])
+                    self._queued -= len(batch)
+                else:
+                    self._queued -= 1
+
+                self._busy += 1
+
+            try:
+                if job[0] == 'write':
+                    self._write_batch(job[1], batch)
+                else:
+                    self._call(job)
+            finally:
+                with self._ready:
+                    self._busy -= 1
+                    self._ready.notify_all()
+
+    def _call(self, job):
+        kind, f, callback = job
+        result, error = None, None
+        try:
+            result = f()
+        except (IOError, OSError, IndexError) as err:
+            error = err
+
+        with self._ready:
+            self._calls += 1
+
+        if not callback is None:
+            self._notify(callback, result, error)
+
+    # A failing callback must not kill the I/O thread
+    def _notify(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            _logger.exception("Disk I/O callback %s failed" % callback)
+
+    def _write_batch(self, path, batch):
+        batch.sort(key = lambda job: job[2])
+
+        # Runs of adjacent writes
+        runs = []
+        for job in batch:
+            if runs and len(runs[-1]) < _IOV_MAX and \
+                    runs[-1][-1][2] + len(runs[-1][-1][3]) == job[2]:
+                runs[-1].append(job)
+            else:
+                runs.append([job])
+
+        for run in runs:
+            error = None
+            synced = False
+            try:
+                with self._pool.file(path) as f:
+                    self._pwrite(f.fileno(), [job[3] for job in run], \
+                                     run[0][2])
+                    if self._sync == SYNC_ALWAYS:
+                        os.fdatasync(f.fileno())
+                        synced = True
+            except (IOError, OSError) as err:
+                _logger.error("Writing to %s failed, with %s" % (path, err))
+                error = err
+
+            with self._ready:
+                self._writes += 1
+                self._coalesced += len(run) - 1
+                self._written += sum(len(job[3]) for job in run)
+                self._dirty.add(path)
+                if synced:
+                    self._syncs += 1
+
+            for job in run:
+                if not job[4] is None:
+                    self._notify(job[4], error)
+
+        if self._sync == SYNC_PERIODIC and \
+                time.time() - self._synced > self._sync_interval:
+            self._sync_dirty()
+
+    def _pwrite(self, fileno, buffers, offset):
+        buffers = [memoryview(b).cast('B') for b in buffers]
+        while buffers:
+            written = os.pwritev(fileno, buffers, offset)
+            offset += written
+
+            # Drop what has been written, pwritev may write less
+            while buffers and written >= len(buffers[0]):
+                written -= len(buffers[0])
+                buffers.pop(0)
+            if buffers:
+                buffers[0] = buffers[0][written:]
+
+    def _sync_dirty(self):
+        with self._ready:
+            dirty = list(self._dirty)
+            self._dirty.clear()
+            self._synced = time.time()
+
+        syncs = 0
+        for path in dirty:
+            try:
+                with self._pool.file(path) as f:
+                    os.fsync(f.fileno())
+                syncs += 1
+            except (IOError, OSError) as err:
+                _logger.error("Syncing %s failed, with %s" % (path, err))
+
+        with self._ready:
+            self._syncs += syncs
+
+
+if __name__ == '__main__':
+    import tempfile
+    import shutil
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'file')
+    open(path, 'wb').close()
+
+    io = DiskIO(sync = SYNC_PERIODIC)
+    done = []
+    for i in reversed(range(64)):
+        io.write(path, i * 16384, bytes([i]) * 16384, done.append)
+
+    io.call(lambda: os.path.getsize(path), lambda size, err: print(size))
+    io.halt()
+
+    with open(path, 'rb') as f:
+        content = f.read()
+
+    print(len(done), all(content[i * 16384] == i for i in range(64)))
+    print(io.statistics())
+
+    shutil.rmtree(directory)
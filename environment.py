@@ -177,9 +177,9 @@ def satisfy_requests(self):
 
         while self._requests:
             request = self._requests.pop()
-            piece = self._manager.request_received(request.index)
-            self.piece(request.index, request.offset, \
-                           piece.block(request.offset, request.length))
+            block = self._manager.request_received(\
+                request.index, request.offset, request.length)
+            self.piece(request.index, request.offset, block)
 
 peer.Peer.satisfy = satisfy_requests
 
@@ -200,6 +200,25 @@ class MemoryStorage(object):
     def has(self, index):
         return self._haves[index]
 
+    def checking(self, index):
+        return False
+
+    def checked(self):
+        return True
+
+    def wanted(self, index):
+        return True
+
+    def partial_pieces(self):
+        return []
+
+    @property
+    def resumed_bytes(self):
+        return 0
+
+    def piece_priority(self, index):
+        return disk.PRIORITY_NORMAL
+
     def completed(self):
         return self._haves.all_set()
 
@@ -247,12 +266,18 @@ class PeerManagerConsole(object):
     def peer_id(self):
         return self._peer_id
 
-    def request_received(self, piece):
+    def request_received(self, index, offset, length, callback = None):
+        block = None
         try:
-            return self._storage.piece(piece)
+            block = self._storage.piece(index).block(offset, length)
         except IOError:
             pass
 
+        if callback is None:
+            return block
+
+        callback(block)
+
     def halt(self):
         for peer in self._peers:
             try:
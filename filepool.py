@@ -0,0 +1,170 @@
+import os
+import logging
+import threading
+import contextlib
+import collections
+
+_logger = logging.getLogger('bittorrent.filepool')
+
+# Open file handles kept by the pool shared by all storages
+MAX_OPEN_FILES = 256
+
+# Pool of open files, shared by storages so the number of open file
+# descriptors stays bounded however many files and torrents there are.
+# Files are opened on demand and the least recently used ones are
+# closed when more than max_open are open. A file in use (see file) is
+# never closed, so the limit may be exceeded while all are in use.
+class FilePool(object):
+    def __init__(self, max_open = MAX_OPEN_FILES):
+        self._max_open = max_open
+        # Path => [file, number of users], least recently used first.
+        # The file is None while it is being opened.
+        self._open = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._opened = threading.Condition(self._lock)
+
+        # Paths opened at least once
+        self._seen = set()
+        self._opens = 0
+        self._reopens = 0
+        self._evictions = 0
+
+    @property
+    def max_open(self):
+        return self._max_open
+
+    @max_open.setter
+    def max_open(self, max_open):
+        with self._lock:
+            self._max_open = max_open
+            self._evict()
+
+    def __len__(self):
+        return len(self._open)
+
+    # Creates the file if it doesn't exist, without keeping it open
+    def create(self, path):
+        if os.path.exists(path):
+            _logger.info("Opening existing file %s" % path)
+        else:
+            _logger.info("Creating file %s" % path)
+            open(path, 'ab').close()
+
+    # Context manager giving the open file at path
+    @contextlib.contextmanager
+    def file(self, path):
+        f = self._acquire(path)
+        try:
+            yield f
+        finally:
+            self._release(path)
+
+    # The file is opened outside the lock, so a slow open (e.g. on a
+    # network file system) only blocks the users of that file
+    def _acquire(self, path):
+        with self._lock:
+            while True:
+                entry = self._open.get(path, None)
+                if entry is None:
+                    break
+                if not entry[0] is None:
+                    self._open.move_to_end(path)
+                    entry[1] += 1
+                    return entry[0]
+
+                self._opened.wait()
+
+            # Reserve the entry, with a user it is never evicted
+            entry = [None, 1]
+            self._open[path] = entry
+
+        try:
+            f = open(path, 'r+b')
+        except:
+            with self._lock:
+                del self._open[path]
+                self._opened.notify_all()
+            raise
+
+        with self._lock:
+            entry[0] = f
+            self._opens += 1
+            if path in self._seen:
+                self._reopens += 1
+            self._seen.add(path)
+
+            self._evict()
+            self._opened.notify_all()
+            return f
+
+    def _release(self, path):
+        with self._lock:
+            entry = self._open.get(path, None)
+            if not entry is None:
+                entry[1] -= 1
+                self._evict()
+
+    def _evict(self):
+        if len(self._open) <= self._max_open:
+            return
+
+        for path in list(self._open):
+            f, users = self._open[path]
+            if users == 0:
+                del self._open[path]
+                self._close(f)
+                self._evictions += 1
+
+                if len(self._open) <= self._max_open:
+                    return
+
+    def _close(self, f):
+        try:
+            f.close()
+        except IOError as err:
+            _logger.error("Could not close %s, with %s" % (f.name, err))
+
+    # Closes the file at path unless it is in use
+    def close(self, path):
+        with self._lock:
+            entry = self._open.get(path, None)
+            if not entry is None and entry[1] == 0:
+                del self._open[path]
+                self._close(entry[0])
+
+            self._seen.discard(path)
+
+    def statistics(self):
+        with self._lock:
+            return {
+                'open': len(self._open),
+                'opens': self._opens,
+                'reopens': self._reopens,
+                'evictions': self._evictions
+            }
+
+pool = FilePool()
+
+if __name__ == '__main__':
+    import tempfile
+    import shutil
+
+    directory = tempfile.mkdtemp()
+    files = FilePool(4)
+
+    paths = [os.path.join(directory, 'file%d' % i) for i in range(10)]
+    for path in paths:
+        files.create(path)
+
+    for round in range(3):
+        for path in paths:
+            with files.file(path) as f:
+                f.seek(0, os.SEEK_END)
+                f.write(b'x')
+
+    print(len(files), files.statistics())
+    for path in paths:
+        files.close(path)
+    print(len(files), os.path.getsize(paths[0]))
+
+    shutil.rmtree(directory)
@@ -2,16 +2,35 @@ import torrent
 import manager
 import tracker_client
 import storage
+import metacache
+import filepool
+import diskio
 import logging
 import peer_id as id
+import utils
 
 import time
 import sys
+import os
 import socket
 import threading
+import queue
+import concurrent.futures
+
+from bencode.bencode_error import BencodeError
 
 logger = logging.getLogger('bittorrent')
 
+# Number of torrents loaded at the same time by start_many, and of
+# torrents whose storage is checked at the same time
+LOAD_WORKERS = 4
+WATCH_INTERVAL = 10 #seconds
+
+# How often torrents are checked for being idle, and when a hibernating
+# torrent is woken to announce if its trackers never replied
+HIBERNATE_INTERVAL = 60 #seconds
+ANNOUNCE_INTERVAL = 30 * 60 #seconds
+
 def setup_logger(level = logging.INFO):
     #global logger
     #logger = logging.getLogger('bittorrent')
@@ -23,12 +42,58 @@ def setup_logger(level = logging.INFO):
     logger.addHandler(sthl)
 
 class Client(object):
-    def __init__(self):
+    # If metadata_cache is the path of a cache file, parsed .torrent
+    # files are kept in it, so later starts don't need to decode them.
+    # Storage is checked in the background, reading at most check_rate
+    # bytes per second if given, and scrubbed every scrub_interval
+    # seconds if given. With mmap_storage files are memory-mapped (see
+    # storage.MmapStorage), otherwise they are read and written with
+    # positional I/O from many threads at once (see
+    # storage.ConcurrentStorage). All torrents keep at most max_open_files
+    # files open if given (see filepool). Pieces are written on disk
+    # I/O threads, disk_sync is the diskio sync policy. Files are sized
+    # according to preallocate (see storage.PREALLOCATE_*).
+    #
+    # With hibernate_after torrents seeding without peers for that many
+    # seconds are hibernated (see manager.PeerManager.hibernate), so
+    # idle torrents hold no threads or open files. They are woken by a
+    # peer connecting for them, or by one scheduler thread shared by
+    # all torrents when their tracker announce is due.
+    def __init__(self, metadata_cache = None, check_rate = None, \
+                     scrub_interval = None, mmap_storage = False, \
+                     max_open_files = None, disk_sync = diskio.SYNC_NONE, \
+                     preallocate = storage.PREALLOCATE_NONE, \
+                     hibernate_after = None):
         self._peer_id = id.generate()
         self._acceptor = manager.ConnectionAcceptor()
         self._wait = threading.Condition()
         
         self._started = False
+        self._lock = threading.RLock()
+        self._watchers = []
+
+        self._check_rate = check_rate
+        # Shared by the checks of all torrents, see recheck.Recheck
+        self._check_slots = threading.BoundedSemaphore(LOAD_WORKERS)
+        self._scrub_interval = scrub_interval
+        self._storage_class = storage.SynchronizedMmapStorage \
+            if mmap_storage else storage.ConcurrentStorage
+
+        if max_open_files:
+            filepool.pool.max_open = max_open_files
+
+        self._disk_io = diskio.DiskIO(sync = disk_sync)
+        self._preallocate = preallocate
+
+        self._hibernate_after = hibernate_after
+        self._scheduler = utils.TimerTask()
+        self._scheduler.start()
+        if hibernate_after:
+            self._scheduler.then(HIBERNATE_INTERVAL, self._hibernate_idle)
+
+        self._metadata_cache = None
+        if metadata_cache:
+            self._metadata_cache = metacache.MetadataCache(metadata_cache)
 
     @property
     def peer_id(self):
@@ -46,9 +111,16 @@ class Client(object):
         return self.managers.get(info_hash, None)
 
     def halt(self):
+        self._scheduler.halt()
+        for watcher in self._watchers:
+            watcher.halt()
+
         for info_hash, manager in self.managers.items():
             manager.halt()
 
+        self._disk_io.halt()
+        self.save_metadata_cache()
+
         try:
             self._acceptor.halt()
         except socket.error as err:
@@ -58,6 +130,27 @@ class Client(object):
         with self._wait:
             self._wait.wait()
 
+    def save_metadata_cache(self):
+        cache = self._metadata_cache
+        if not cache is None and cache.dirty():
+            try:
+                cache.save()
+            except (IOError, OSError) as err:
+                logger.info("Could not save metadata cache, %s" % err)
+
+    def _hibernate_idle(self):
+        for info_hash, man in list(self.managers.items()):
+            if man.idle(self._hibernate_after) and man.hibernate():
+                when = man.tracker.next_announce() or \
+                    time.time() + ANNOUNCE_INTERVAL
+                self._scheduler.at(when, self._announce_due, man)
+
+        self._scheduler.then(HIBERNATE_INTERVAL, self._hibernate_idle)
+
+    def _announce_due(self, man):
+        if man.hibernating:
+            man.wake()
+
     def halt_manager(self, info_hash):
         man = self.manager(info_hash)
         if not man is None:
@@ -66,31 +159,165 @@ class Client(object):
 
         return man
 
-    def start(self, torrent_path_or_content):
+    # Only the files with a priority other than storage.PRIORITY_SKIP
+    # are downloaded, see storage.Storage for file_priorities
+    def start(self, torrent_path_or_content, file_priorities = None):
+        meta, store = self._load(torrent_path_or_content, file_priorities)
+        return self._launch(meta, store)
+
+    # Loads the .torrent files at the paths using a pool of workers.
+    # Every torrent is started as soon as it is loaded, its storage is
+    # checked in the background. After each torrent has been checked
+    # progress is called with the number of torrents done, the total
+    # number, the path and the error if loading failed (otherwise None),
+    # with progress this waits for all the checks. Returns a dictionary
+    # of path to manager (None for failed torrents).
+    def start_many(self, paths, workers = LOAD_WORKERS, progress = None):
+        paths = list(paths)
+        managers = {}
+        # (path, error) of every torrent checked or failed
+        finished = queue.Queue()
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            futures = dict((pool.submit(self._load, p), p) for p in paths)
+
+            for future in concurrent.futures.as_completed(futures):
+                path = futures[future]
+                try:
+                    managers[path] = self._launch(*future.result(), \
+                        done = lambda path = path: finished.put((path, None)))
+                except (IOError, OSError, BencodeError, ValueError) as err:
+                    logger.error("Could not start torrent %s, with %s" % \
+                                     (path, err))
+                    managers[path] = None
+                    finished.put((path, err))
+
+        self.save_metadata_cache()
+
+        if progress:
+            for done in range(len(paths)):
+                path, error = finished.get()
+                progress(done + 1, len(paths), path, error)
+
+        return managers
+
+    # Starts all .torrent files in the directory, and keeps checking it
+    # for new ones every interval seconds
+    def watch_directory(self, directory, interval = WATCH_INTERVAL, \
+                            workers = LOAD_WORKERS, progress = None):
+        watcher = DirectoryWatcher(self, directory, interval, \
+                                       workers, progress)
+        self._watchers.append(watcher)
+        watcher.start()
+        return watcher
+
+    def _load(self, torrent_path_or_content, file_priorities = None):
         meta = None
         if isinstance(torrent_path_or_content, bytes):
             meta = torrent.Torrent(torrent_path_or_content)
+        elif not self._metadata_cache is None:
+            meta = self._metadata_cache.torrent(torrent_path_or_content)
         else:
             meta = torrent.Torrent.from_file(torrent_path_or_content)
         
-        store = storage.SynchronizedStorage(meta)
+        # No second storage over the files of a running torrent
+        if not self.manager(meta.info_hash) is None:
+            return meta, None
+
+        store = self._storage_class(meta, background = True, \
+            disk_io = self._disk_io, preallocate = self._preallocate, \
+            file_priorities = file_priorities)
+        return meta, store
+
+    # done() is called once the storage has been checked
+    def _launch(self, meta, store, done = None):
+        with self._lock:
+            running = self.manager(meta.info_hash)
+            if not running is None:
+                # Loaded concurrently with the running one
+                if not store is None:
+                    store.discard()
+                if not done is None:
+                    done()
+                return running
+
+            # Halted between loading and launching
+            if store is None:
+                raise ValueError("Torrent %s was halted while starting" % \
+                                     meta.name)
+
+            coord = manager.PeerManager(\
+                self._peer_id, self._acceptor, meta, store)
+            tracker = tracker_client.AsyncTrackerManager(\
+                coord, store.missing(), self._acceptor.port)
+            coord.set_tracker(tracker)
 
-        coord = manager.PeerManager(\
-            self._peer_id, self._acceptor, meta, store)
-        tracker = tracker_client.AsyncTrackerManager(\
-            coord, store.missing(), self._acceptor.port)
-        coord.set_tracker(tracker)
+            store.recheck(rate = self._check_rate, \
+                              callback = coord.piece_checked, \
+                              slots = self._check_slots, done = done)
+            if self._scrub_interval:
+                store.scrub(self._scrub_interval, rate = self._check_rate, \
+                                callback = coord.piece_checked)
 
-        coord.start()
+            coord.start()
 
-        if not self._started:
-            self._started = True
-            self._acceptor.start()
+            if not self._started:
+                self._started = True
+                self._acceptor.start()
+
+            return coord
 
     #time.sleep(120)
 
     #coord.halt()
 
+class DirectoryWatcher(threading.Thread):
+    def __init__(self, client, directory, interval = WATCH_INTERVAL, \
+                     workers = LOAD_WORKERS, progress = None):
+        super(DirectoryWatcher, self).__init__()
+        self.daemon = True
+
+        self._client = client
+        self._directory = directory
+        self._interval = interval
+        self._workers = workers
+        self._progress = progress
+
+        self._seen = set()
+        self._halt = threading.Event()
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def halt(self):
+        self._halt.set()
+
+    # Starts the .torrent files which have been added since the last scan
+    def scan(self):
+        try:
+            names = os.listdir(self._directory)
+        except OSError as err:
+            logger.error("Could not list directory %s, with %s" % \
+                             (self._directory, err))
+            return {}
+
+        paths = [os.path.join(self._directory, n) for n in sorted(names) \
+                     if n.endswith('.torrent')]
+        paths = [p for p in paths if not p in self._seen]
+        self._seen.update(paths)
+
+        if not paths:
+            return {}
+
+        return self._client.start_many(paths, self._workers, self._progress)
+
+    def run(self):
+        while not self._halt.is_set():
+            self.scan()
+            self._halt.wait(self._interval)
+
+
 if __name__ == '__main__':
     torrent_path = 'trusted-computing.torrent'
 
@@ -9,7 +9,9 @@ import storage
 import peer
 import utils
 import bitfield
+import merkle
 import protocol
+import torrentfile
 import tracker_client
 
 # TODO LIST
@@ -53,6 +55,15 @@ MAX_PEERS = 30
 DELTA_PEERS = 5
 
 STALE = 120 #seconds
+# Leaf hashes of a bad piece not received in time, the whole piece is
+# downloaded again
+HASH_TIMEOUT = 30 #seconds
+
+# Streaming, see Stream
+STREAM_WINDOW = 20 #pieces
+STREAM_RATE = 1024 * 1024 #bytes per second
+RACE_MARGIN = 2 #seconds
+MAX_RACERS = 3 #peers per piece
 
 class ConnectionAcceptor(threading.Thread):
     def __init__(self, ports = PORTS):
@@ -131,7 +142,9 @@ class ConnectionAcceptor(threading.Thread):
 
 
 class DownloadTask(object):
-    def __init__(self, piece, man):
+    # Only the blocks at offsets are requested if given, the piece
+    # already has the others
+    def __init__(self, piece, man, offsets = None):
         #threading.Thread.__init__(self)
         #self.daemon = True
 
@@ -140,7 +153,9 @@ class DownloadTask(object):
 
         self._peers = utils.SynchronizedList()
         self._requests = utils.SynchronizedList()
-        self._create_requests(self._requests, piece)
+        self._create_requests(self._requests, piece, offsets)
+        # Block offset => peer the block was received from
+        self._senders = {}
 
         self._last_contact = time.time()
 
@@ -159,29 +174,62 @@ class DownloadTask(object):
         except TypeError:
             return False
 
-    def _create_requests(self, requests, piece):
-        offset = 0
-        while offset < piece.length:
+    def _create_requests(self, requests, piece, \
+                             offsets = None):
+        if offsets is None:
+            offsets = range(0, piece.length, BLOCK_LENGTH)
+
+        for offset in offsets:
             length = BLOCK_LENGTH if offset + BLOCK_LENGTH <= piece.length\
                 else piece.length - offset
             requests.append(\
                 protocol.request_message(piece.index, offset, length))
-            offset += BLOCK_LENGTH
 
     @property
     def index(self):
         return self._piece.index
 
+    @property
+    def piece(self):
+        return self._piece
+
+    # Download the blocks at the given offsets (all by default) again,
+    # after the piece failed the hash check
+    def reset(self, offsets = None):
+        with self._requests:
+            for offset in offsets or []:
+                sender = self._senders.get(offset, None)
+                if not sender is None:
+                    sender.bad_block()
+
+            # The hash check may fail without a bad block, e.g. when
+            # only the SHA1 of a hybrid torrent's piece is wrong
+            if not offsets:
+                offsets = None
+
+            del self._requests[:]
+            self._create_requests(self._requests, self._piece, offsets)
+            self._last_contact = time.time()
+
     def done(self):
         return not bool(self._requests)
 
+    # Offsets of the blocks received so far
+    def received(self):
+        with self._requests:
+            missing = set(r.offset for r in self._requests)
+
+        return [offset for offset in range(0, self._piece.length, \
+                                               BLOCK_LENGTH) \
+                    if not offset in missing]
+
     # Called by the peer manager to check if the taks needs more
     # peers to help download the piece
     def stale(self):
         return not self.done() or not bool(self._peers) or \
             time.time() - self._last_contact > STALE
 
-    def piece_received(self, piece, request):
+    def piece_received(self, piece, request, peer = None):
         with self._requests:
             if not request in self._requests:
                 _logger.debug(\
@@ -195,7 +243,14 @@ class DownloadTask(object):
                     request.length != len(piece.block):
                 raise ValueError("Piece does not match request")
 
-            self._piece.set_block(piece.offset, piece.block)
+            if not self._piece.set_block(piece.offset, piece.block):
+                _logger.info("Got bad block %d of piece %d from %s" % \
+                                 (piece.offset, piece.index, peer))
+                if not peer is None:
+                    peer.bad_block()
+                return
+
+            self._senders[piece.offset] = peer
             self._requests.remove(request)
             self._last_contact = time.time()
             _logger.debug("Got PIECE message: %s" % piece)
@@ -260,6 +315,77 @@ class DownloadTask(object):
         with self._peers:
             self._peers.append(peer)
 
+    def number_of_peers(self):
+        with self._peers:
+            return len(self._peers)
+
+
+# A torrent read from a cursor onwards at rate bytes per second, the
+# piece i pieces after the one at the cursor is needed i + 1 piece
+# lengths worth of reading after the cursor was set (its deadline).
+# Pieces within window pieces of the cursor are downloaded in order of
+# their deadlines, and raced across up to MAX_RACERS peers once their
+# deadline is less than RACE_MARGIN seconds away. A sequential read
+# moves the cursor along with advance, which keeps the deadlines.
+#
+# The time to first byte is the time from setting the cursor until the
+# piece at the cursor is had, a stall is a piece in the window had
+# after its deadline.
+class Stream(object):
+    def __init__(self, torrent, offset = 0, window = STREAM_WINDOW, \
+                     rate = STREAM_RATE):
+        self._torrent = torrent
+        self._window = window
+        self._rate = float(rate)
+
+        self._stalls = 0
+        self._races = 0
+        self._first_byte = None
+        self.seek(offset)
+
+    @property
+    def cursor(self):
+        return self._cursor
+
+    # Moves the cursor to the byte at offset
+    def seek(self, offset):
+        self._cursor = offset // self._torrent.piece_length
+        self._start = self._cursor
+        self._seeked = time.time()
+        self._first_byte = None
+
+    # Moves the cursor to the byte at offset, reached by reading on
+    def advance(self, offset):
+        self._cursor = offset // self._torrent.piece_length
+
+    def window(self):
+        return range(self._cursor, min(self._cursor + self._window, \
+                                           self._torrent.number_of_pieces))
+
+    def deadline(self, index):
+        return self._seeked + (index - self._start + 1) * \
+            self._torrent.piece_length / self._rate
+
+    def raced(self):
+        self._races += 1
+
+    # Called when a piece has been had, or was had when the cursor was set
+    def piece_done(self, index):
+        now = time.time()
+        if index == self._start and self._first_byte is None:
+            self._first_byte = now - self._seeked
+
+        if index in self.window() and now > self.deadline(index):
+            self._stalls += 1
+
+    def statistics(self):
+        return {
+            'cursor': self._cursor,
+            'time to first byte': self._first_byte,
+            'stalls': self._stalls,
+            'races': self._races
+        }
+
 
 class PeerMonitor(threading.Thread):
     def __init__(self, man):
@@ -268,7 +394,7 @@ class PeerMonitor(threading.Thread):
 
         self._manager = man
 
-        self._halt = False
+        self._halt = threading.Event()
 
         self._round = 0
         self._downloaders = []
@@ -303,10 +429,13 @@ class PeerMonitor(threading.Thread):
     def snubbed(self):
         self._optimistic += 1
 
+    def halt(self):
+        self._halt.set()
+
     def run(self):
-        while not self._halt:
+        while not self._halt.is_set():
             self._unchoke_peers()
-            time.sleep(UNCHOKE_INTERVAL)
+            self._halt.wait(UNCHOKE_INTERVAL)
 
     # Called every ten seconds. Unchokes four peers based on how much
     # they uploaded to us (if we are actively downloading, else
@@ -373,15 +502,30 @@ class PeerManager(object):
         self._peers = utils.SynchronizedList()
         self._tasks = []
         self._wanted_pieces = utils.SynchronizedList()
+        # (pieces root, leaf index) => (task waiting for leaf hashes,
+        # peer asked for them)
+        self._hash_requests = {}
 
         self._piece_count = bitfield.Vector.create(\
             torrent.number_of_pieces)
 
         self._halt = False
         self._state = 'initialized'
-
+        self._stream = None
+        # Notified whenever we get a piece, see wait_for_piece
+        self._arrived = threading.Condition()
+
+        # Hibernating torrents have no threads, see hibernate
+        self._hibernating = False
+        self._hibernation = threading.Lock()
+        self._idle_since = time.time()
+
+        # Pieces still being checked by the storage are wanted only if
+        # they turn out to be missing, see piece_checked. Skipped pieces
+        # are never wanted.
         for piece in range(torrent.number_of_pieces):
-            if not storage.has(piece):
+            if not storage.has(piece) and not storage.checking(piece) and \
+                    storage.wanted(piece):
                 self._wanted_pieces.append(piece)
 
         if self.completed():
@@ -389,14 +533,40 @@ class PeerManager(object):
             self._state = 'seeding'
 
         acceptor.add_manager(self)
+        self._start_threads()
+
+        # Pieces partly downloaded before a restart are resumed first
+        for index in storage.partial_pieces():
+            if index in self._wanted_pieces:
+                self._resume_piece(index)
+
+        if storage.resumed_bytes:
+            _logger.info("Resumed %d bytes of partly downloaded pieces" % \
+                             storage.resumed_bytes)
+
+        #self._contact_tracker()
+
+    def _resume_piece(self, index):
+        piece, offsets = self._storage.partial_piece(index)
+        if not offsets:
+            return
+
+        missing = [offset for offset in range(0, piece.length, BLOCK_LENGTH) \
+                       if not offset in offsets]
+        task = DownloadTask(piece, self, missing)
+        self._wanted_pieces.remove(index)
+        self._tasks.append(task)
+
+        if task.done():
+            self.got_piece(piece)
+
+    def _start_threads(self):
         self._worker = utils.TimerTask()
         self._worker.start()
 
         self._monitor = PeerMonitor(self)
         self._monitor.start()
 
-        #self._contact_tracker()
-
     def set_tracker(self, tracker):
         self._tracker_client = tracker
 
@@ -430,7 +600,153 @@ class PeerManager(object):
 
     def completed(self):
         with self._wanted_pieces:
-            return not bool(self._wanted_pieces)
+            return not bool(self._wanted_pieces) and self._storage.checked()
+
+    # Sets the download priority of file f, see storage.PRIORITY_*
+    def set_file_priority(self, f, priority):
+        self._set_priority(self._storage.set_file_priority, f, priority)
+
+    # Sets the priority of a piece, None for the one of its files
+    def set_piece_priority(self, index, priority):
+        self._set_priority(self._storage.set_piece_priority, index, priority)
+
+    # Sets the priorities of several pieces at once, a dictionary of
+    # piece index to priority
+    def set_piece_priorities(self, priorities):
+        self._set_priority(self._storage.set_piece_priorities, priorities)
+
+    def _set_priority(self, set_priority, *args):
+        if self._hibernating:
+            self.wake()
+
+        with self._wanted_pieces:
+            left = self._storage.missing()
+            # Wanted pieces are checked in the background first
+            wanted = set_priority(*args, callback = self.piece_checked)
+
+            # Pieces being downloaded are finished even if skipped now
+            self._wanted_pieces[:] = [p for p in self._wanted_pieces \
+                                          if self._storage.wanted(p)]
+            for piece in wanted:
+                if not self._storage.has(piece) and \
+                        not self._storage.checking(piece) and \
+                        not piece in self._wanted_pieces and \
+                        not piece in self._tasks:
+                    self._wanted_pieces.append(piece)
+
+            if not self._tracker_client is None:
+                self._tracker_client.update_left(\
+                    left - self._storage.missing())
+
+            if self._state == 'seeding' and not self.completed():
+                self._state = 'initialized'
+
+        if wanted:
+            self._contact_tracker()
+
+    @property
+    def stream(self):
+        return self._stream
+
+    # Downloads the pieces from the byte at offset onwards first, see
+    # Stream. Returns the stream, move its cursor with seek.
+    def start_streaming(self, offset = 0, window = STREAM_WINDOW, \
+                            rate = STREAM_RATE):
+        with self._wanted_pieces:
+            self._stream = Stream(self._torrent, offset, window, rate)
+            self._seeked()
+            return self._stream
+
+    def seek(self, offset):
+        with self._wanted_pieces:
+            self._stream.seek(offset)
+            self._seeked()
+
+    # Moves the cursor of the stream along a sequential read
+    def advance(self, offset):
+        with self._wanted_pieces:
+            self._stream.advance(offset)
+
+    def _seeked(self):
+        cursor = self._stream.cursor
+        if cursor < self._torrent.number_of_pieces and \
+                self._storage.has(cursor):
+            self._stream.piece_done(cursor)
+
+    # Back to rarest first
+    def stop_streaming(self):
+        with self._wanted_pieces:
+            self._stream = None
+
+    # A file-like reader of file f (index or path), see torrentfile
+    def open_file(self, f, window = None, rate = None, timeout = None):
+        return torrentfile.TorrentFile(self, f, window, rate, timeout)
+
+    # Waits until we have the piece, for at most timeout seconds if
+    # given. Returns false if we still don't have it.
+    def wait_for_piece(self, index, timeout = None):
+        with self._arrived:
+            self._arrived.wait_for(\
+                lambda: self._storage.has(index) or self._halt, timeout)
+
+            if not self._storage.has(index) and self._halt:
+                raise IOError("Torrent %s has been halted" % \
+                                  self._torrent.name)
+
+            return self._storage.has(index)
+
+    def _piece_arrived(self):
+        with self._arrived:
+            self._arrived.notify_all()
+
+    @property
+    def hibernating(self):
+        return self._hibernating
+
+    # Seeding without any peer for at least after seconds
+    def idle(self, after):
+        return self._state == 'seeding' and not self._peers and \
+            time.time() - self._idle_since >= after
+
+    # Stops the threads of the torrent (ours and the tracker's), closes
+    # its files and drops everything but the pieces we have, until wake
+    # is called: when a peer connects for the torrent, or when the
+    # tracker is to be contacted again (see tracker.next_announce).
+    def hibernate(self):
+        with self._hibernation:
+            if self._hibernating or self._halt:
+                return False
+
+            _logger.info("Hibernating %s" % self._torrent.name)
+            self._hibernating = True
+            self._state = 'hibernating'
+
+            self._worker.halt()
+            self._monitor.halt()
+            self._tracker_client.hibernate()
+            self._storage.hibernate()
+            self._piece_count = None
+
+            return True
+
+    def wake(self):
+        with self._hibernation:
+            if not self._hibernating or self._halt:
+                return False
+
+            _logger.info("Waking %s" % self._torrent.name)
+            self._piece_count = bitfield.Vector.create(\
+                self._torrent.number_of_pieces)
+            self._storage.wake()
+            self._tracker_client.wake()
+            self._start_threads()
+
+            self._idle_since = time.time()
+            self._state = 'seeding'
+            self._hibernating = False
+
+        self._contact_tracker()
+        return True
 
     def start(self):
         self._contact_tracker()
@@ -442,9 +758,21 @@ class PeerManager(object):
 
         self._halt = True
         self._state = 'finished' if self.completed() else 'stopped'
+        self._piece_arrived()
         self._tracker_client.stopped()
 
         self._worker.halt()
+        self._monitor.halt()
+
+        # The blocks of the pieces being downloaded are kept for a restart
+        for task in list(self._tasks):
+            received = task.received()
+            if received and not task.done():
+                try:
+                    self._storage.save_partial(task.piece, received)
+                except (IOError, OSError) as err:
+                    _logger.error("Could not save piece %d, with %s" % \
+                                      (task.index, err))
 
         try:
             self._storage.halt()
@@ -476,24 +804,46 @@ class PeerManager(object):
                 if peer.ready():
                     self._piece_count -= peer.haves.to_vector()
 
+                if not self._peers:
+                    self._idle_since = time.time()
+
                 if len(self._peers) < MAX_PEERS - DELTA_PEERS:
                     self._contact_tracker()
 
+        # Hashes asked for from the peer will not arrive
+        with self._wanted_pieces:
+            for key, (task, p) in list(self._hash_requests.items()):
+                if p is peer:
+                    del self._hash_requests[key]
+                    task.reset()
+
     # Called when a critical error ocurres - UNUSED
     def crititacl_error(self, err):
         pass
 
     # Called when a REQUEST message has been received from a peer
-    # that we currently not are choking
-    def request_received(self, piece):
+    # that we currently not are choking. Returns the block, or with a
+    # callback reads it without waiting on the disk and calls
+    # callback(block), block is None if reading failed.
+    def request_received(self, index, offset, length, callback = None):
         #if not self._storage.has(piece):
         #    raise ValueError("Requested piece not in storage")
 
+        if not callback is None:
+            def read(block, error):
+                if not error is None:
+                    _logger.critical("Piece (%d) retrieval failed, with %s" %\
+                                         (index, error))
+                callback(block)
+
+            self._storage.read_block_async(index, offset, length, read)
+            return None
+
         try:
-            return self._storage.piece(piece)
+            return self._storage.read_block(index, offset, length)
         except IOError as err:
             _logger.critical("Piece (%d) retrieval failed, with %s" %\
-                                 (piece, err))
+                                 (index, err))
 
         return None
 
@@ -520,6 +870,105 @@ class PeerManager(object):
 
             return False
 
+    # Called when a HASH REQUEST message has been received. Returns
+    # the requested hashes, or None to reject the request. Piece layers
+    # are served from the metainfo and block hashes from pieces we have.
+    def hash_request_received(self, req):
+        if req.proof_layers != 0 or req.length == 0 or \
+                req.length & (req.length - 1) or req.index % req.length:
+            return None
+
+        height = merkle.piece_height(self._torrent.piece_length)
+        if req.base_layer == height:
+            layer = self._torrent.piece_layer(req.pieces_root)
+            if layer is None:
+                return None
+
+            hashes = merkle.split(layer)
+            if req.index >= len(hashes):
+                return None
+
+            hashes = hashes[req.index:req.index + req.length]
+            hashes += [merkle.zero_hash(height)] * \
+                (req.length - len(hashes))
+            return b''.join(hashes)
+        elif req.base_layer == 0:
+            piece = self._hash_request_piece(req)
+            if piece is None or not self._storage.has(piece):
+                return None
+
+            try:
+                leaves = self._storage.piece(piece).leaf_hashes()
+            except IOError:
+                return None
+
+            leaves += [merkle.zero_hash(0)] * (req.length - len(leaves))
+            return b''.join(leaves)
+
+        return None
+
+    # The piece whose leaves are requested, if it's exactly one piece
+    def _hash_request_piece(self, req):
+        torrent = self._torrent
+        for f in range(torrent.number_of_files):
+            if torrent.file_pieces_root(f) != req.pieces_root:
+                continue
+
+            offset = torrent.file_offset(f)
+            piece = offset // torrent.piece_length + \
+                req.index * merkle.BLOCK_SIZE // torrent.piece_length
+            m = torrent.piece_merkle(piece) \
+                if piece < torrent.number_of_pieces else None
+            if not m is None and m.pieces_root == req.pieces_root and \
+                    m.leaf_index == req.index and m.leaf_count == req.length:
+                return piece
+
+            return None
+
+        return None
+
+    # Called when a HASHES message has been received
+    def hashes_received(self, peer, msg):
+        self._worker.now(self._hashes_received, peer, msg)
+
+    def _hashes_received(self, peer, msg):
+        with self._wanted_pieces:
+            task, p = self._hash_requests.pop(\
+                (msg.pieces_root, msg.index), (None, None))
+            if task is None or msg.base_layer != 0 or \
+                    msg.length != task.piece.merkle.leaf_count:
+                _logger.info("Unexpected hashes from %s" % peer)
+                if not task is None:
+                    task.reset()
+                return
+
+            leaves = merkle.split(msg.hashes)[0:msg.length]
+            if len(leaves) == msg.length and task.piece.set_leaves(leaves):
+                bad = task.piece.bad_blocks()
+                _logger.info("Downloading %d bad blocks of piece %d again" % \
+                                 (len(bad), task.index))
+                task.reset(bad)
+            else:
+                _logger.info("Got invalid hashes from %s" % peer)
+                task.reset()
+
+    # Called when a HASH REJECT message has been received
+    def hash_rejected(self, peer, msg):
+        with self._wanted_pieces:
+            task, p = self._hash_requests.pop(\
+                (msg.pieces_root, msg.index), (None, None))
+            if not task is None:
+                task.reset()
+
+    def _hash_timeout(self, key, task):
+        with self._wanted_pieces:
+            pending = self._hash_requests.get(key, None)
+            if not pending is None and pending[0] is task:
+                del self._hash_requests[key]
+                _logger.info("No hashes for piece %d from %s" % \
+                                 (task.index, pending[1]))
+                task.reset()
+
     def interested_received(self, peer):
         self._monitor.interested(peer)
 
@@ -532,6 +981,11 @@ class PeerManager(object):
             if self.completed() or self._halt:
                 return None
 
+            if not self._stream is None:
+                task = self._stream_piece(peer, bitfield, self._stream)
+                if not task is None:
+                    return task
+
             for task in self._tasks:
                 if task.stale() and bitfield.get(task.index):
                     task.add_peer(peer)
@@ -541,18 +995,43 @@ class PeerManager(object):
                 return None
 
             next = self._select_piece(bitfield)
-            #task = DownloadTask(self._storage.piece(next), self)
-            task = DownloadTask(self._storage.empty_piece(next), self)#\
-                #storage.Piece.create_empty_piece(\
-                #    next, self._torrent.piece_size(next)), self)
-            self._wanted_pieces.remove(next)
-            self._tasks.append(task)
-            task.add_peer(peer)
-
-            return task
+            return self._start_task(next, peer)
             # Check if the existing tasks need more peers - DONE
             # Start a task with the peer and return task - DONE
 
+    def _start_task(self, index, peer):
+        #task = DownloadTask(self._storage.piece(next), self)
+        task = DownloadTask(self._storage.empty_piece(index), self)#\
+            #storage.Piece.create_empty_piece(\
+            #    next, self._torrent.piece_size(next)), self)
+        self._wanted_pieces.remove(index)
+        self._tasks.append(task)
+        task.add_peer(peer)
+
+        return task
+
+    # The task for the piece the peer has with the earliest deadline in
+    # the stream window, pieces already being downloaded are raced when
+    # their deadline is near. None if the peer has none of the pieces.
+    def _stream_piece(self, peer, bitfield, stream):
+        now = time.time()
+        for index in stream.window():
+            if not bitfield.get(index) or self._storage.has(index):
+                continue
+
+            task = next((t for t in self._tasks if t.index == index), None)
+            if task is None:
+                if index in self._wanted_pieces:
+                    return self._start_task(index, peer)
+            elif stream.deadline(index) - now < RACE_MARGIN and \
+                    not task.has_peer(peer) and \
+                    task.number_of_peers() < MAX_RACERS:
+                stream.raced()
+                task.add_peer(peer)
+                return task
+
+        return None
+
     def tracker_responded(self, resp):
         for addr in resp.peers_enum():
             if not self.need_more():
@@ -575,8 +1054,36 @@ class PeerManager(object):
     def got_piece(self, piece):
         self._worker.now(self._got_piece, piece)
 
+    # Called by the storage when a piece has been checked in the
+    # background, or has been found corrupted while scrubbing
+    def piece_checked(self, index, valid):
+        self._worker.now(self._piece_checked, index, valid)
+
+    def _piece_checked(self, index, valid):
+        with self._wanted_pieces:
+            if self._halt:
+                return
+
+            if valid:
+                self._tracker_client.update_left(\
+                    self._torrent.piece_size(index))
+                self._send_have(index)
+                self._piece_arrived()
+            elif not index in self._wanted_pieces and \
+                    not index in self._tasks and self._storage.wanted(index):
+                _logger.info("Piece %d is missing" % index)
+                self._wanted_pieces.append(index)
+
+            if self.completed() and self._state != 'seeding':
+                _logger.info("File already completed")
+                self._state = 'seeding'
+
     # Called when a piece has been finished downloading
     def _got_piece(self, piece):
+        # Finish hashing the piece before taking the lock, the result is
+        # kept by the piece for write_piece
+        piece.valid()
+
         with self._wanted_pieces:
             if self.completed() or self._halt:
                 return
@@ -590,20 +1097,72 @@ class PeerManager(object):
                     _logger.info(\
                         "Got a piece %d we are not interested in" % index)
                 else:
-                    if self._storage.write_piece(piece):
-                        #self._wanted_pieces.remove(index)
-                        self._tasks.remove(task)
-                        self._tracker_client.update_left(piece.length)
-                        self._send_have(index)
-                        self._complete()
-                        _logger.info("Valid piece %d downloaded" % index)
-                    else:
+                    # The task is done once the piece has been written
+                    if not self._storage.write_piece_async(\
+                            piece, self.piece_written):
                         _logger.info("Got bad piece %d" % index)
+                        self._bad_piece(task)
             except IOError as err:
                 _logger.critical(\
                     "Writing to storage failed, with %s" % err)
                 # What now? Try to open a new storage? Ignore?
 
+    # Called by the storage when a piece has been written
+    def piece_written(self, piece, error):
+        self._worker.now(self._piece_written, piece, error)
+
+    def _piece_written(self, piece, error):
+        with self._wanted_pieces:
+            if self._halt:
+                return
+
+            index = piece.index
+            task = next((t for t in self._tasks if t.index == index), None)
+            if task is None:
+                return
+
+            if not error is None:
+                _logger.critical(\
+                    "Writing to storage failed, with %s" % error)
+                task.reset()
+                return
+
+            #self._wanted_pieces.remove(index)
+            self._tasks.remove(task)
+            if not self._stream is None:
+                self._stream.piece_done(index)
+            self._piece_arrived()
+
+            self._tracker_client.update_left(piece.length)
+            self._send_have(index)
+            self._complete()
+            _logger.info("Valid piece %d downloaded" % index)
+
+    # With a merkle tree only the corrupted blocks of a bad piece are
+    # downloaded again. The leaf hashes needed to find them are asked
+    # for from a peer which has the piece, unless the piece is a single
+    # block.
+    def _bad_piece(self, task):
+        m = task.piece.merkle
+        if m is None:
+            task.reset()
+        elif m.leaf_count == 1:
+            task.piece.set_leaves([m.expected])
+            task.reset(task.piece.bad_blocks())
+        else:
+            with self._peers:
+                peer = next((p for p in self._peers if p.supports_v2 and \
+                                 p.ready() and p.has(task.index)), None)
+
+            if peer is None:
+                task.reset()
+            else:
+                key = (m.pieces_root, m.leaf_index)
+                self._hash_requests[key] = (task, peer)
+                self._worker.then(HASH_TIMEOUT, self._hash_timeout, key, task)
+                peer.hash_request(m.pieces_root, 0, m.leaf_index, \
+                                      m.leaf_count)
+
     #def _tracker_task(self):
     #    self._worker.now(self._contact_tracker)
 
@@ -615,6 +1174,12 @@ class PeerManager(object):
 
     def _select_piece(self, bitfield):
         wanted = [p for p in self._wanted_pieces if bitfield[p]]
+
+        # Only the pieces of the highest priority the peer has
+        priority = self._storage.piece_priority
+        top = max([priority(p) for p in wanted] or [0])
+        wanted = [p for p in wanted if priority(p) == top]
+
         sorted(wanted, key = lambda p: self._piece_count[p])
         
         #top = PeerManager.RAREST_PIECES
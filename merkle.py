@@ -0,0 +1,61 @@
+import hashlib
+
+# SHA-256 merkle trees as used by BitTorrent v2 (BEP 52). The leaves
+# are the hashes of the 16 KiB blocks of a file, the last block may be
+# shorter. Trees are padded to a power of two number of leaves with
+# zero hashes.
+
+BLOCK_SIZE = 16384
+HASH_SIZE = 32
+
+_zero_hashes = [b'\x00' * HASH_SIZE]
+
+def block_hash(block):
+    return hashlib.sha256(block).digest()
+
+# Hash of a tree with 2**height zero leaves
+def zero_hash(height):
+    while len(_zero_hashes) <= height:
+        last = _zero_hashes[-1]
+        _zero_hashes.append(hashlib.sha256(last + last).digest())
+
+    return _zero_hashes[height]
+
+def next_power_of_two(n):
+    return 1 << (n - 1).bit_length() if n > 1 else 1
+
+# Height of the layer with one hash per piece, above the leaves
+def piece_height(piece_length):
+    return (piece_length // BLOCK_SIZE).bit_length() - 1
+
+def leaf_hashes(data):
+    view = memoryview(data)
+    return [block_hash(view[i:i + BLOCK_SIZE]) \
+                for i in range(0, len(view), BLOCK_SIZE)]
+
+# Root of the tree whose layer at the given height is hashes, padded
+# with zero hashes to count entries (by default the next power of two)
+def root(hashes, count = None, height = 0):
+    layer = list(hashes)
+    count = count or next_power_of_two(len(layer))
+    if len(layer) > count:
+        raise ValueError("More hashes than the size of the layer")
+
+    layer.extend([zero_hash(height)] * (count - len(layer)))
+    while len(layer) > 1:
+        layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest() \
+                     for i in range(0, len(layer), 2)]
+
+    return layer[0]
+
+def split(hashes):
+    view = memoryview(hashes)
+    return [bytes(view[i:i + HASH_SIZE]) \
+                for i in range(0, len(view), HASH_SIZE)]
+
+if __name__ == '__main__':
+    data = b'\x01' * (3 * BLOCK_SIZE + 100)
+    leaves = leaf_hashes(data)
+    print(len(leaves), root(leaves).hex())
+    print(root(leaves[0:2]) == root([root(leaves[0:2])], 1, 1))
+    print(zero_hash(2).hex())
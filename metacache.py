@@ -0,0 +1,329 @@
+import os
+import mmap
+import array
+import struct
+import logging
+import threading
+
+import torrent
+
+_logger = logging.getLogger('bittorrent.metacache')
+
+# Binary cache of parsed torrent metadata. Entries are keyed by the path
+# of the .torrent file together with its size and modification time, and
+# hold everything needed to recreate a torrent.Torrent without decoding
+# bencode: info hash, announce tiers, file table and piece hashes. The
+# cache file is memory-mapped, and the piece hashes of cached torrents
+# are views into the mapping.
+#
+# File layout (little-endian):
+#     header: magic, version, number of entries
+#     entry:  length of the rest of the entry, file size, mtime (ns),
+#             path, then the metadata (see _pack)
+#
+# Version 2 added the BEP 47 file attributes (empty for none).
+
+MAGIC = b'BLMC'
+VERSION = 2
+
+_header = struct.Struct('<4sII')
+_entry = struct.Struct('<IQq')
+_metadata = struct.Struct('<20sQB')
+_length = struct.Struct('<I')
+
+NO_ANNOUNCE_LIST = 0xffffffff
+
+def _pack_string(value, out):
+    value = value.encode('UTF-8')
+    out.append(_length.pack(len(value)))
+    out.append(value)
+
+def _unpack_string(buf, off):
+    length, = _length.unpack_from(buf, off)
+    off += _length.size
+    return str(buf[off:off + length], 'UTF-8'), off + length
+
+def _pack(key, size, mtime, meta):
+    out = []
+    _pack_string(key, out)
+
+    out.append(_metadata.pack(meta.info_hash, meta.piece_length, \
+                                  meta.is_single_file))
+    _pack_string(meta.name, out)
+    _pack_string(meta.announce, out)
+
+    if meta.announce_list is None:
+        out.append(_length.pack(NO_ANNOUNCE_LIST))
+    else:
+        out.append(_length.pack(len(meta.announce_list)))
+        for tier in meta.announce_list:
+            out.append(_length.pack(len(tier)))
+            for url in tier:
+                _pack_string(url, out)
+
+    files = meta.files
+    out.append(_length.pack(len(files)))
+    out.append(array.array('q', [length for path, length in files])\
+                   .tobytes())
+    for path, length in files:
+        out.append(_length.pack(len(path)))
+        for part in path:
+            _pack_string(part, out)
+    for f in range(len(files)):
+        _pack_string(meta.file_attrs(f), out)
+
+    out.append(_length.pack(len(meta.pieces)))
+    out.append(meta.pieces)
+
+    body = b''.join(out)
+    return _entry.pack(_entry.size - _length.size + len(body), \
+                           size, mtime) + body
+
+def _unpack(buf, off):
+    path, off = _unpack_string(buf, off)
+    info_hash, piece_length, single = _metadata.unpack_from(buf, off)
+    off += _metadata.size
+
+    name, off = _unpack_string(buf, off)
+    announce, off = _unpack_string(buf, off)
+
+    tiers, = _length.unpack_from(buf, off)
+    off += _length.size
+    announce_list = None
+    if tiers != NO_ANNOUNCE_LIST:
+        announce_list = []
+        for t in range(tiers):
+            count, = _length.unpack_from(buf, off)
+            off += _length.size
+            tier = []
+            for i in range(count):
+                url, off = _unpack_string(buf, off)
+                tier.append(url)
+            announce_list.append(tier)
+
+    count, = _length.unpack_from(buf, off)
+    off += _length.size
+    lengths = array.array('q')
+    lengths.frombytes(buf[off:off + 8 * count])
+    off += 8 * count
+
+    paths = []
+    for f in range(count):
+        parts, = _length.unpack_from(buf, off)
+        off += _length.size
+        path = []
+        for p in range(parts):
+            part, off = _unpack_string(buf, off)
+            path.append(part)
+        paths.append(path)
+
+    attrs = []
+    for f in range(count):
+        attr, off = _unpack_string(buf, off)
+        attrs.append(attr)
+
+    length, = _length.unpack_from(buf, off)
+    off += _length.size
+    pieces = buf[off:off + length]
+
+    return torrent.Torrent.from_metadata(info_hash, announce, \
+        announce_list, name, piece_length, pieces, paths, lengths, \
+        bool(single), attrs)
+
+
+class MetadataCache(object):
+    def __init__(self, cache_path):
+        self._path = cache_path
+        self._lock = threading.RLock()
+
+        self._map = None
+        self._view = None
+        # path => (size, mtime, offset of entry in the mapping)
+        self._index = {}
+        # path => packed entry, added since the cache was loaded
+        self._added = {}
+
+        self._load()
+
+    def _load(self):
+        self._index = {}
+        if not os.path.exists(self._path):
+            return
+
+        try:
+            with open(self._path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < _header.size:
+                    raise ValueError("Truncated header")
+
+                self._map = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+            self._view = memoryview(self._map)
+            magic, version, count = _header.unpack_from(self._view, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("Unknown cache format")
+
+            off = _header.size
+            for i in range(count):
+                length, size, mtime = _entry.unpack_from(self._view, off)
+                path, ignore = _unpack_string(self._view, off + _entry.size)
+                self._index[path] = (size, mtime, off)
+                off += _length.size + length
+        except (ValueError, struct.error, OSError) as err:
+            _logger.info("Ignoring metadata cache %s, %s" % (self._path, err))
+            self._index = {}
+
+    def _stat(self, torrent_path):
+        stat = os.stat(torrent_path)
+        return os.path.abspath(torrent_path), stat.st_size, stat.st_mtime_ns
+
+    @property
+    def path(self):
+        return self._path
+
+    def __len__(self):
+        with self._lock:
+            return len(set(self._index) | set(self._added))
+
+    def __contains__(self, torrent_path):
+        key, size, mtime = self._stat(torrent_path)
+        with self._lock:
+            return self._lookup(key, size, mtime) is not None
+
+    def _lookup(self, key, size, mtime):
+        if key in self._added:
+            entry = self._added[key]
+            length, s, m = _entry.unpack_from(entry, 0)
+            if (s, m) == (size, mtime):
+                return memoryview(entry), 0
+        elif key in self._index:
+            s, m, off = self._index[key]
+            if (s, m) == (size, mtime):
+                return self._view, off
+
+        return None
+
+    # Returns the torrent.Torrent for the .torrent file at the path,
+    # from the cache if the file is unchanged, otherwise the file is
+    # parsed and added to the cache.
+    def torrent(self, torrent_path):
+        key, size, mtime = self._stat(torrent_path)
+        with self._lock:
+            found = self._lookup(key, size, mtime)
+
+        if not found is None:
+            buf, off = found
+            return _unpack(buf, off + _entry.size)
+
+        meta = torrent.Torrent.from_file(torrent_path)
+        self.put(torrent_path, meta)
+        return meta
+
+    # Only BitTorrent v1 torrents are cached, v2 metadata (file tree and
+    # piece layers) is not part of the cache format
+    def put(self, torrent_path, meta):
+        if meta.version != 1:
+            return
+
+        key, size, mtime = self._stat(torrent_path)
+        entry = _pack(key, size, mtime, meta)
+        with self._lock:
+            self._added[key] = entry
+
+    def dirty(self):
+        return bool(self._added)
+
+    # Writes all entries to the cache file. Entries of .torrent files
+    # which have been removed or changed are dropped if prune is true.
+    def save(self, prune = True):
+        with self._lock:
+            entries = []
+            keys = set(self._index) | set(self._added)
+
+            for key in sorted(keys):
+                if prune:
+                    try:
+                        k, size, mtime = self._stat(key)
+                        if self._lookup(key, size, mtime) is None:
+                            continue
+                    except OSError:
+                        continue
+
+                if key in self._added:
+                    entries.append(self._added[key])
+                else:
+                    size, mtime, off = self._index[key]
+                    length, = _length.unpack_from(self._view, off)
+                    entries.append(self._view[off:off + _length.size + length])
+
+            temp = self._path + '.tmp'
+            with open(temp, 'wb') as f:
+                f.write(_header.pack(MAGIC, VERSION, len(entries)))
+                for entry in entries:
+                    f.write(entry)
+            os.replace(temp, self._path)
+
+            # Torrents created from the old mapping keep it alive
+            self._map = None
+            self._view = None
+            self._added = {}
+            self._load()
+
+
+def _benchmark(number_of_torrents = 500, number_of_files = 100, \
+                   number_of_pieces = 2000):
+    import tempfile
+    import time
+    import bencode.bencoder as bencoder
+
+    directory = tempfile.mkdtemp()
+    paths = []
+    for t in range(number_of_torrents):
+        files = [{'length': 1000, 'path': ['dir%d' % t, 'file%d' % f]} \
+                     for f in range(number_of_files)]
+        content = bencoder.encode({
+            'announce': 'http://tracker/announce',
+            'announce-list': [['http://tracker/announce'], \
+                                  ['http://backup/announce']],
+            'info': {
+                'name': 'torrent%d' % t,
+                'piece length': 50,
+                'pieces': os.urandom(20) * number_of_pieces,
+                'files': files
+            }
+        })
+        paths.append(os.path.join(directory, '%d.torrent' % t))
+        with open(paths[-1], 'wb') as f:
+            f.write(content)
+
+    cache_path = os.path.join(directory, 'metadata.cache')
+
+    start = time.perf_counter()
+    cold = [torrent.Torrent.from_file(p) for p in paths]
+    cold_time = time.perf_counter() - start
+
+    cache = MetadataCache(cache_path)
+    for p in paths:
+        cache.torrent(p)
+    cache.save()
+
+    start = time.perf_counter()
+    cache = MetadataCache(cache_path)
+    cached = [cache.torrent(p) for p in paths]
+    cached_time = time.perf_counter() - start
+
+    for a, b in zip(cold, cached):
+        assert a.info_hash == b.info_hash and a.files == b.files and \
+            bytes(a.pieces) == bytes(b.pieces)
+
+    print("%d torrents, %d files and %d pieces each" % \
+              (number_of_torrents, number_of_files, number_of_pieces))
+    print(" - cold start   %.3f s" % cold_time)
+    print(" - cached start %.3f s" % cached_time)
+
+    for p in paths:
+        os.remove(p)
+    os.remove(cache_path)
+    os.rmdir(directory)
+
+if __name__ == '__main__':
+    _benchmark()
@@ -22,12 +22,17 @@ def accept_handshake(sock, addr, managers):
             for manager in managers:
                 torrent = manager.torrent
                 if torrent.info_hash == hs.info_hash:
+                    if manager.hibernating:
+                        manager.wake()
+
                     if not manager.need_more():
                         break
 
                     peer = Peer(hs.peer_id, sock, addr,\
-                                torrent.number_of_pieces, manager)
-                    send_handshake(sock, manager.peer_id, torrent.info_hash)
+                                torrent.number_of_pieces, manager, \
+                                hs.reserved)
+                    send_handshake(sock, manager.peer_id, torrent.info_hash, \
+                                       _reserved(torrent))
                     manager.add_peer(peer)
                     return
         except (ValueError, socket.error, socket.timeout, struct.error) as err:
@@ -47,7 +52,8 @@ def initiate_handshake(addr, manager):
             sock.connect(addr)
 
             torrent = manager.torrent
-            send_handshake(sock, manager.peer_id, torrent.info_hash)
+            send_handshake(sock, manager.peer_id, torrent.info_hash, \
+                               _reserved(torrent))
             hs = receive_handshake(sock, addr)
             
             if hs.info_hash != torrent.info_hash:
@@ -55,7 +61,7 @@ def initiate_handshake(addr, manager):
                 return
         
             peer = Peer(hs.peer_id, sock, addr, \
-                            torrent.number_of_pieces, manager)
+                            torrent.number_of_pieces, manager, hs.reserved)
             manager.add_peer(peer)
         except (ValueError, socket.error, socket.timeout, struct.error) as err:
             _logger.info("Handshake failed with peer %s, bacause %s" % \
@@ -66,8 +72,13 @@ def initiate_handshake(addr, manager):
     hs.daemon = True
     hs.start()
 
-def send_handshake(sock, peer_id, info_hash):
-    hs = protocol.handshake_message(info_hash, peer_id)
+# Reserved bits advertised in the handshake for the torrent
+def _reserved(torrent):
+    return protocol.V2_RESERVED if torrent.version == 2 else \
+        protocol.RESERVED
+
+def send_handshake(sock, peer_id, info_hash, reserved = protocol.RESERVED):
+    hs = protocol.handshake_message(info_hash, peer_id, reserved)
     sock.settimeout(HANDSHAKE_TIMEOUT)
     sock.send(hs.payload())
 
@@ -194,8 +205,10 @@ class MessageOut(threading.Thread):
 
 
 class Peer(object):
-    def __init__(self, peer_id, sock, addr, pieces, manager):
+    def __init__(self, peer_id, sock, addr, pieces, manager, \
+                     reserved = protocol.RESERVED):
         self._pieces = pieces
+        self._reserved = reserved
         self._manager = manager
         self._id = peer_id
         self._hex_id = ''.join(['%02x' % b for b in peer_id])
@@ -208,6 +221,8 @@ class Peer(object):
         self._uploaded = 0
         # How much the peer has downloaded from us
         self._downloaded = 0
+        # Blocks received from the peer which failed the hash check
+        self._bad_blocks = 0
 
         self._tasks = []
         self._outstanding_requests = []
@@ -275,6 +290,15 @@ class Peer(object):
     def uploaded(self):
         return self._uploaded
 
+    @property
+    def bad_blocks(self):
+        return self._bad_blocks
+
+    # The peer can answer hash requests (BitTorrent v2)
+    @property
+    def supports_v2(self):
+        return protocol.supports_v2(self._reserved)
+
     @property
     def choking(self):
         return self._choking
@@ -360,6 +384,14 @@ class Peer(object):
         self._out.add_message(protocol.cancel_message(\
                 index, offset, length))
 
+    def hash_request(self, pieces_root, base_layer, index, length, \
+                         proof_layers = 0):
+        self._out.add_message(protocol.hash_request_message(\
+                pieces_root, base_layer, index, length, proof_layers))
+
+    def bad_block(self):
+        self._bad_blocks += 1
+
     def disconnected(self):
         # Tell coordinator the peer has disconnected
         self.halt()
@@ -414,10 +446,12 @@ class Peer(object):
             elif id == protocol.REQUEST:
                 req = protocol.parse_request(msg)
                 if not self._choking and self._interested:
-                    piece = self._manager.request_received(req.index)
-                    if piece:
-                        data = piece.block(req.offset, req.length)
-                        self.piece(req.index, req.offset, data)
+                    def send(data, req = req):
+                        if not data is None:
+                            self.piece(req.index, req.offset, data)
+
+                    self._manager.request_received(\
+                        req.index, req.offset, req.length, send)
                 # If we are choking this peer ignore - DONE
                 # Else get piece from storage and send via out - DONE
             elif id == protocol.PIECE:
@@ -433,6 +467,23 @@ class Peer(object):
             elif id == protocol.PORT:
                 # Not supported. Ignore.
                 pass
+            elif id == protocol.HASH_REQUEST:
+                req = protocol.parse_hash_request(msg)
+                hashes = self._manager.hash_request_received(req)
+                if hashes is None:
+                    self._out.add_message(protocol.hash_reject_message(\
+                            req.pieces_root, req.base_layer, req.index, \
+                                req.length, req.proof_layers))
+                else:
+                    self._out.add_message(protocol.hashes_message(\
+                            req.pieces_root, req.base_layer, req.index, \
+                                req.length, req.proof_layers, hashes))
+            elif id == protocol.HASHES:
+                self._manager.hashes_received(\
+                    self, protocol.parse_hashes(msg))
+            elif id == protocol.HASH_REJECT:
+                self._manager.hash_rejected(\
+                    self, protocol.parse_hash_reject(msg))
             else:
                 raise ValueError(\
                     "Message with unknown id %d received" % id)
@@ -507,7 +558,7 @@ class Peer(object):
                                 and r.length == len(piece.block)), None)
 
                 if not req is None:
-                    task.piece_received(piece, req)
+                    task.piece_received(piece, req, self)
                     self._outstanding_requests.remove(req)
                     return
 
@@ -17,6 +17,10 @@ REQUEST = 6
 PIECE = 7
 CANCEL = 8
 PORT = 9
+# BitTorrent v2 (BEP 52)
+HASH_REQUEST = 21
+HASHES = 22
+HASH_REJECT = 23
 
 MESSAGE_NAMES = [
     'handshake',
@@ -33,6 +37,12 @@ MESSAGE_NAMES = [
     'port'
 ]
 
+V2_MESSAGE_NAMES = {
+    HASH_REQUEST: 'hash request',
+    HASHES: 'hashes',
+    HASH_REJECT: 'hash reject'
+}
+
 # Handshake length without len(pstr) and the first byte 
 # representing that value (pstrlen). Total length of handshake
 # message: HANDSHAKE_LENGTH  + pstrlen + 1.
@@ -47,9 +57,16 @@ BITFIELD_LENGTH = 1
 REQUEST_LENGTH = 13
 PIECE_LENGTH = 9
 CANCEL_LENGTH = 13
+HASH_REQUEST_LENGTH = 49
+HASHES_LENGTH = 49
 
 PSTR = b'BitTorrent protocol'
 RESERVED = b'\x00' * 8
+# Set in the last reserved byte by peers supporting BitTorrent v2
+V2_RESERVED = b'\x00' * 7 + b'\x10'
+
+def supports_v2(reserved):
+    return len(reserved) == 8 and bool(reserved[7] & 0x10)
 
 def parse_pstrlen(len):
     len, = struct.unpack('!B', len)
@@ -70,7 +87,7 @@ def message_name(id):
     if -2 <= id <= 9:
         return MESSAGE_NAMES[id + 2]
 
-    return None
+    return V2_MESSAGE_NAMES.get(id, None)
 
 def _error(msg, expected, msg_type, op = lambda x,y: x == y):
     if not op(len(msg), expected):
@@ -82,7 +99,7 @@ def parse_handshake(pstrlen, handshake):
     _error(handshake, HANDSHAKE_LENGTH + pstrlen, 'handshake')
 
     pstr = handshake[0 : pstrlen]
-    reserved = handshake[pstrlen : 8]
+    reserved = handshake[pstrlen : pstrlen + 8]
     info_hash = handshake[pstrlen + 8 : pstrlen + 28]
     peer_id = handshake[pstrlen + 28 : pstrlen + 48]
 
@@ -137,6 +154,25 @@ def parse_cancel(msg):
     index, offset, length = struct.unpack('!3I', msg[1:])
     return cancel_message(index, offset, length)
 
+def parse_hash_request(msg):
+    _error(msg, HASH_REQUEST_LENGTH, 'hash request')
+    root = msg[1:33]
+    layer, index, length, proof = struct.unpack('!4I', msg[33:49])
+    return hash_request_message(root, layer, index, length, proof)
+
+def parse_hashes(msg):
+    _error(msg, HASHES_LENGTH, 'hashes', \
+               lambda x,y: x >= y and (x - y) % 32 == 0)
+    root = msg[1:33]
+    layer, index, length, proof = struct.unpack('!4I', msg[33:49])
+    return hashes_message(root, layer, index, length, proof, msg[49:])
+
+def parse_hash_reject(msg):
+    _error(msg, HASH_REQUEST_LENGTH, 'hash reject')
+    root = msg[1:33]
+    layer, index, length, proof = struct.unpack('!4I', msg[33:49])
+    return hash_reject_message(root, layer, index, length, proof)
+
 
 #def handshake_message(info_hash, peer_id, reserved = RESERVED, pstr = PSTR#):
 #    m = Message(HANDSHAKE, HANDSHAKE_LENGTH + len(pstr))
@@ -442,6 +478,86 @@ def cancel_message(index, offset, length):
     req._id = CANCEL
     return req
 
+# Requests length hashes of the given layer (0 are the 16 KiB block
+# hashes) of the merkle tree with the root pieces_root, starting at
+# index, together with proof_layers layers of uncle hashes
+class hash_request_message(Message):
+    def __init__(self, pieces_root, base_layer, index, length, \
+                     proof_layers):
+        super(hash_request_message, self).__init__(\
+            HASH_REQUEST, HASH_REQUEST_LENGTH)
+
+        self._pieces_root = pieces_root
+        self._base_layer = base_layer
+        self._index = index
+        self._length = length
+        self._proof_layers = proof_layers
+
+    def __eq__(self, other):
+        return isinstance(other, hash_request_message) and\
+            self._pieces_root == other._pieces_root and\
+            self._base_layer == other._base_layer and\
+            self._index == other._index and\
+            self._length == other._length and\
+            self._proof_layers == other._proof_layers
+
+    def __str__(self):
+        return "<%s Message len=%d layer=%d index=%d length=%d>" % \
+            (self._name.upper(), self._len, self._base_layer, \
+                 self._index, self._length)
+
+    @property
+    def pieces_root(self):
+        return self._pieces_root
+
+    @property
+    def base_layer(self):
+        return self._base_layer
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def length(self):
+        return self._length
+
+    @property
+    def proof_layers(self):
+        return self._proof_layers
+
+    def payload(self):
+        pre = Message.payload(self)
+        return pre + self._pieces_root + struct.pack(\
+            '!4I', self._base_layer, self._index, self._length, \
+                self._proof_layers)
+
+class hashes_message(hash_request_message):
+    def __init__(self, pieces_root, base_layer, index, length, \
+                     proof_layers, hashes):
+        super(hashes_message, self).__init__(\
+            pieces_root, base_layer, index, length, proof_layers)
+
+        self._id = HASHES
+        self._name = message_name(HASHES)
+        self._len = HASHES_LENGTH + len(hashes)
+        self._hashes = hashes
+
+    @property
+    def hashes(self):
+        return self._hashes
+
+    def payload(self):
+        return super(hashes_message, self).payload() + self._hashes
+
+def hash_reject_message(pieces_root, base_layer, index, length, \
+                            proof_layers):
+    req = hash_request_message(\
+        pieces_root, base_layer, index, length, proof_layers)
+    req._id = HASH_REJECT
+    req._name = message_name(HASH_REJECT)
+    return req
+
 if __name__ == '__main__':
     import bitfield
 
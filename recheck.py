@@ -0,0 +1,142 @@
+import os
+import time
+import logging
+import threading
+import collections
+import concurrent.futures
+
+import utils
+
+_logger = logging.getLogger('bittorrent.recheck')
+
+CHECK_WORKERS = os.cpu_count() or 1
+# Seconds between two scrubs of the pieces we have
+SCRUB_INTERVAL = 24 * 60 * 60
+# Seconds between looking for halt while waiting for a slot
+SLOT_WAIT = 0.1
+
+# Checks pieces of a storage against their hashes using a pool of
+# threads (hashlib releases the GIL while hashing). Pieces are checked
+# in order of their offset, so the files are read sequentially, and
+# each result is given to the storage as soon as it is known, so the
+# pieces found can be served before the whole check is done. Reading is
+# limited to rate bytes per second if given.
+#
+# With an interval the pieces we have are checked again every interval
+# seconds (scrubbing), pieces which have been corrupted on disk are
+# dropped from the storage.
+#
+# callback(index, valid) is called when a piece has been checked for
+# the first time and when a piece turns out to be corrupted.
+#
+# slots is a semaphore shared by checks to bound how many of them read
+# at once, a check waits for a slot before each round. done() is called
+# when the first round is over (or the check was halted before).
+class Recheck(threading.Thread):
+    def __init__(self, storage, pieces = None, workers = CHECK_WORKERS, \
+                     rate = None, callback = None, interval = None, \
+                     slots = None, done = None):
+        super(Recheck, self).__init__()
+        self.daemon = True
+
+        self._storage = storage
+        self._pieces = None if pieces is None else sorted(pieces)
+        self._workers = workers or CHECK_WORKERS
+        self._bucket = None if not rate else utils.TokenBucket(rate)
+        self._callback = callback
+        self._interval = interval
+        self._slots = slots
+        self._done_callback = done
+
+        self._checked = 0
+        self._halt = threading.Event()
+
+    # Number of pieces checked so far
+    @property
+    def checked(self):
+        return self._checked
+
+    def halt(self):
+        self._halt.set()
+
+    def run(self):
+        try:
+            self._run()
+        finally:
+            self._finished()
+
+    def _run(self):
+        pieces = self._pieces
+        # The pieces we have were checked when the storage was opened
+        if pieces is None and not self._interval is None:
+            self._halt.wait(self._interval)
+
+        while self._acquire():
+            try:
+                if pieces is None:
+                    pieces = self._storage.pieces()
+
+                start = time.time()
+                self.check(pieces)
+                _logger.info("Checked %d pieces in %.1f s" % \
+                                 (len(pieces), time.time() - start))
+            finally:
+                if not self._slots is None:
+                    self._slots.release()
+
+            self._finished()
+            if self._interval is None:
+                break
+
+            self._halt.wait(self._interval)
+            pieces = None
+
+    # Waits for a slot, false if halted first
+    def _acquire(self):
+        if self._slots is None:
+            return not self._halt.is_set()
+
+        while not self._halt.is_set():
+            if self._slots.acquire(timeout = SLOT_WAIT):
+                return True
+
+        return False
+
+    def _finished(self):
+        done, self._done_callback = self._done_callback, None
+        if not done is None:
+            done()
+
+    def check(self, pieces):
+        torrent = self._storage.torrent
+
+        with concurrent.futures.ThreadPoolExecutor(self._workers) as pool:
+            window = collections.deque()
+
+            for index in pieces:
+                if self._halt.is_set():
+                    break
+
+                if not self._bucket is None:
+                    self._bucket.consume(torrent.piece_size(index))
+
+                window.append(\
+                    (index, pool.submit(self._storage.check_piece, index)))
+                if len(window) >= 2 * self._workers:
+                    self._done(*window.popleft())
+
+            while window:
+                self._done(*window.popleft())
+
+    def _done(self, index, future):
+        try:
+            valid = future.result()
+        except (IOError, OSError) as err:
+            _logger.error("Checking piece %d failed, with %s" % (index, err))
+            valid = False
+
+        if self._storage.piece_checked(index, valid) and \
+                not self._callback is None:
+            self._callback(index, valid)
+
+        self._checked += 1
@@ -1,91 +1,683 @@
 import hashlib
+import errno
 import os
+import mmap
+import time
 import logging
+import threading
+import contextlib
+import collections
 
 import bitfield
+import filepool
+import merkle
+import recheck
 import utils
+from bencode import bencoder, schema
+from bencode.bencode_error import BencodeError
 
 
 _logger = logging.getLogger('bittorrent.storage')
 
 DEFAULT_ROOT_DIR = 'downloads'
 
+# Fast-resume data is written at most this often while downloading
+RESUME_INTERVAL = 30 #seconds
+
+# How files are sized when the storage is opened: left to grow as
+# pieces are written, extended to their full size without allocating
+# disk space (sparse), or with all their disk space allocated up front
+# (posix_fallocate), which keeps large files from fragmenting
+PREALLOCATE_NONE = 'none'
+PREALLOCATE_SPARSE = 'sparse'
+PREALLOCATE_FULL = 'full'
+
+# Download priorities of files and pieces, skipped ones are not
+# downloaded (see Storage)
+PRIORITY_SKIP = 0
+PRIORITY_LOW = 1
+PRIORITY_NORMAL = 4
+PRIORITY_HIGH = 7
+
+# Bytes of downloaded pieces SHA1 hashed as the blocks arrived, and
+# when the piece was checked after the last block
+_hash_counters = {'incremental': 0, 'completion': 0}
+_hash_counters_lock = threading.Lock()
+
+def _count_hashed(counter, length):
+    with _hash_counters_lock:
+        _hash_counters[counter] += length
+
+def hash_counters():
+    with _hash_counters_lock:
+        return dict(_hash_counters)
+
+# Memory used by the piece cache shared by all storages
+PIECE_CACHE_SIZE = 64 * 1024 * 1024 #bytes
+
+# Least recently used cache of whole pieces, keyed by (info hash, piece
+# index), holding at most size bytes. Uploading a block reads its whole
+# piece into the cache, so the following requests for the rest of the
+# piece, from the same or other peers, are served from memory.
+class PieceCache(object):
+    def __init__(self, size = PIECE_CACHE_SIZE):
+        self._size = size
+        self._used = 0
+        self._pieces = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return len(self._pieces)
+
+    def get(self, key):
+        with self._lock:
+            data = self._pieces.get(key, None)
+            if data is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._pieces.move_to_end(key)
+
+            return data
+
+    def put(self, key, data):
+        length = len(data)
+        if length > self._size:
+            return
+
+        with self._lock:
+            if key in self._pieces:
+                self._used -= len(self._pieces.pop(key))
+
+            while self._used + length > self._size:
+                k, evicted = self._pieces.popitem(last = False)
+                self._used -= len(evicted)
+                self._evictions += 1
+
+            self._pieces[key] = data
+            self._used += length
+
+    # Drops every piece of the torrent
+    def discard_torrent(self, info_hash):
+        with self._lock:
+            for key in [k for k in self._pieces if k[0] == info_hash]:
+                self._used -= len(self._pieces.pop(key))
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._pieces:
+                self._used -= len(self._pieces.pop(key))
+
+    def statistics(self):
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'pieces': len(self._pieces),
+                'bytes': self._used
+            }
+
+piece_cache = PieceCache()
+
+class _ResumeFile(schema.Record):
+    fields = (
+        schema.Field('size', int),
+        schema.Field('mtime', int)
+    )
+
+# Blocks of a piece being downloaded saved with save_partial, a packed
+# bitfield with a bit per block
+class _ResumePartial(schema.Record):
+    fields = (
+        schema.Field('piece', int),
+        schema.Field('blocks', bytes)
+    )
+
+class _Resume(schema.Record):
+    fields = (
+        schema.Field('info hash', bytes),
+        schema.Field('haves', bytes),
+        schema.Field('in progress', schema.List(int)),
+        schema.Field('files', schema.List(_ResumeFile)),
+        schema.Field('partial', schema.List(_ResumePartial), [])
+    )
+
+def _pwrite(fileno, data, offset):
+    view = memoryview(data).cast('B')
+    while view:
+        written = os.pwrite(fileno, view, offset)
+        view = view[written:]
+        offset += written
+
+def resume_path(torrent, root_dir = DEFAULT_ROOT_DIR):
+    return os.path.join(root_dir, torrent.hex_info_hash + '.resume')
+
+def part_path(torrent, root_dir = DEFAULT_ROOT_DIR):
+    return os.path.join(root_dir, torrent.hex_info_hash + '.parts')
+
+# The pieces are checked against their hashes when the storage is
+# opened. With fast-resume data (the pieces we have, the pieces which
+# were being written and the size and modification time of every file)
+# only the pieces of files which have changed since it was saved, and
+# the pieces which were being written, are checked. The blocks received
+# for pieces not downloaded yet are kept across restarts as well, see
+# save_partial.
+#
+# With background set the constructor doesn't check anything, the
+# pieces to check are left pending until recheck is called. Pending
+# pieces are neither had nor missing (see checking). Pieces lying
+# entirely in holes of the files (never written to) are missing without
+# being read, so a new torrent needs no checking at all.
+#
+# Files are sized according to preallocate (one of PREALLOCATE_*).
+#
+# Every file has a priority (PRIORITY_*, file_priorities is a list, or a
+# dictionary of file index to priority, the rest are PRIORITY_NORMAL),
+# and a piece has the highest priority of the files it spans unless
+# set with set_piece_priority. Skipped pieces are not wanted and not
+# checked. Skipped files are not created: the parts of them within
+# wanted pieces (the pieces they share with wanted files) are kept in
+# a sparse part file, at their offset in the torrent, until the file is
+# wanted.
+#
+# Files are opened on demand through a filepool.FilePool, by default
+# the one shared by all storages. With a diskio.DiskIO pieces can be
+# written, and blocks read, without waiting on the disk (see
+# write_piece_async and read_block_async).
 class Storage(object):
-    def __init__(self, torrent, root_dir = DEFAULT_ROOT_DIR):
+    def __init__(self, torrent, root_dir = DEFAULT_ROOT_DIR, resume = True, \
+                     background = False, cache = None, file_pool = None, \
+                     disk_io = None, preallocate = PREALLOCATE_NONE, \
+                     file_priorities = None):
+        if not preallocate in (PREALLOCATE_NONE, PREALLOCATE_SPARSE, \
+                                   PREALLOCATE_FULL):
+            raise ValueError("Unknown preallocation " + str(preallocate))
+
         self._torrent = torrent
+        self._preallocate = preallocate
+
+        self._file_priorities = [PRIORITY_NORMAL] * torrent.number_of_files
+        if isinstance(file_priorities, dict):
+            file_priorities = file_priorities.items()
+        elif not file_priorities is None:
+            file_priorities = enumerate(file_priorities)
+        for f, priority in file_priorities or ():
+            self._file_priorities[f] = priority
+
+        # Piece index => priority, overriding the one of its files
+        self._piece_priorities = {}
+        self._priorities = self._piece_priority_table()
+        self._cache = piece_cache if cache is None else cache
+        self._pool = filepool.pool if file_pool is None else file_pool
+        self._io = disk_io
         self._haves = bitfield.Bitfield(torrent.number_of_pieces)
+        self._writing = set()
+        self._pending = set()
+        # Piece index => packed bitfield of the blocks saved on disk
+        self._partial = {}
+        self._resumed = 0
+        self._background = background
+        self._checks = []
+        # Arguments of scrub, restarted by wake
+        self._scrub = None
+
+        self._resume_path = resume_path(torrent, root_dir) \
+            if resume else None
+        self._resume_saved = time.time()
+
         _logger.info("Creating/opening files")
         self._create_files(torrent, root_dir)
 
     def _create_files(self, torrent, root_dir):
+        # Paths of the files, None for padding files
         self._files = []
+        # Files kept in the part file
+        self._parted = set()
+        self._part_path = part_path(torrent, root_dir)
         
-        if root_dir and not os.path.exists(root_dir):
-            os.makedirs(root_dir)
+        # Several storages may be created concurrently in the same root
+        if root_dir:
+            os.makedirs(root_dir, exist_ok = True)
 
         base = os.path.join(root_dir, torrent.name)
         if torrent.is_single_file:
-            f = self._open_file(base)
-            self._files.append(f)
+            self._files.append(base)
+            self._open_file(0)
         else:
-            if not os.path.exists(base):
-                os.makedirs(base)
-
             for i in range(torrent.number_of_files):
-                path = torrent.file_path(i)
-                dirs = path[0:-1]
+                # Padding files are zeros and never written to disk
+                if torrent.is_pad_file(i):
+                    self._files.append(None)
+                    continue
 
-                if dirs and not os.path.exists(os.path.join(base, *dirs)):
-                    os.makedirs(dirs)
+                self._files.append(os.path.join(base, *torrent.file_path(i)))
+                self._open_file(i)
 
-                f = self._open_file(os.path.join(base, *path))
-                self._files.append(f)
+        if self._parted:
+            self._pool.create(self._part_path)
+        else:
+            self._remove_part_file()
 
-        for i in range(torrent.number_of_pieces):
-            piece = self._piece(i)
-            self._haves.set(i, piece.valid())
+        check = self._load_resume()
+        if check is None:
+            check = range(torrent.number_of_pieces)
+
+        check = [i for i in check if self._priorities[i] != PRIORITY_SKIP]
+        holes = self._holes(check)
+        if holes:
+            _logger.info("%d pieces are in holes of the files" % len(holes))
+            check = [i for i in check if not i in holes]
+
+        if self._background:
+            self._pending.update(check)
+            _logger.info("%d pieces left to check" % len(check))
+            return
+
+        _logger.info("Checking %d pieces" % len(check))
+        recheck.Recheck(self, check).check(check)
         
         size = self.size()
         _logger.info("Has file %d/%d bytes" % \
                          (size, torrent.length))
 
-    def _open_file(self, path):
-        f = None
+    # Creates file f, unless it is skipped and doesn't exist yet
+    def _open_file(self, f):
+        path = self._files[f]
+        exists = os.path.exists(path)
+        if not exists and self._file_priorities[f] == PRIORITY_SKIP:
+            self._parted.add(f)
+            return
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+        self._pool.create(path)
+        self._allocate(path, self._torrent.file_size(f))
+
+        if not exists and os.path.exists(self._part_path):
+            self._unpart(f)
+
+    # Copies what the part file holds of file f into the file
+    def _unpart(self, f):
+        start = self._torrent.file_offset(f)
+        end = start + self._torrent.file_size(f)
+        ranges = self._data_ranges(self._part_path, start, end)
+
+        with self._pool.file(self._part_path) as part, \
+                self._pool.file(self._files[f]) as fio:
+            for s, e in ranges:
+                _pwrite(fio.fileno(), os.pread(part.fileno(), e - s, s), \
+                            s - start)
+
+    # The part file is removed once every file in it has been created
+    def _remove_part_file(self):
+        self._pool.close(self._part_path)
         try:
-            f = open(path, 'r+b')
-            _logger.info("Opening existing file %s" % path)
-        except IOError:
-            f = open(path, 'w+b')
-            _logger.info("Creating file %s" % path)
+            os.remove(self._part_path)
+        except FileNotFoundError:
+            pass
 
-        return f
+    # Path and offset of offset off in file f, the files in the part
+    # file are at their offset in the torrent
+    def _location(self, f, off):
+        if f in self._parted:
+            return self._part_path, self._torrent.file_offset(f) + off
 
-    def _close_files(self):
-        for f in self._files:
+        return self._files[f], off
+
+    def _allocate(self, path, size):
+        if self._preallocate == PREALLOCATE_NONE:
+            return
+
+        with self._pool.file(path) as fio:
+            fileno = fio.fileno()
+            stat = os.fstat(fileno)
+
+            if self._preallocate == PREALLOCATE_FULL and \
+                    stat.st_blocks * 512 < size:
+                try:
+                    os.posix_fallocate(fileno, 0, size)
+                    return
+                except (AttributeError, OSError) as err:
+                    _logger.info("Could not preallocate %s, with %s" % \
+                                     (path, err))
+
+            if stat.st_size < size:
+                os.ftruncate(fileno, size)
+
+    # Ranges (start, end) of the file between offset and end holding
+    # data, everything else is a hole reading as zeros. The whole range
+    # if the file system can't tell.
+    def _data_ranges(self, path, offset, end):
+        if not hasattr(os, 'SEEK_DATA'):
+            return [(offset, end)]
+
+        ranges = []
+        with self._pool.file(path) as fio:
+            fileno = fio.fileno()
             try:
-                f.close()
-            except IOError:
-                pass
+                while offset < end:
+                    start = os.lseek(fileno, offset, os.SEEK_DATA)
+                    if start >= end:
+                        break
+
+                    offset = os.lseek(fileno, start, os.SEEK_HOLE)
+                    ranges.append((start, min(offset, end)))
+            except OSError as err:
+                # ENXIO, no data after offset
+                if err.errno != errno.ENXIO:
+                    return [(offset, end)]
+
+        return ranges
+
+    # The pieces, among the given ones, without a byte of file data
+    def _holes(self, pieces):
+        torrent = self._torrent
+        length = torrent.piece_length
+
+        # Pieces with data
+        data = bytearray(torrent.number_of_pieces)
+        for f, path in enumerate(self._files):
+            size = torrent.file_size(f)
+            if path is None or size == 0:
+                continue
+
+            path, at = self._location(f, 0)
+            offset = torrent.file_offset(f) - at
+            for start, end in self._data_ranges(path, at, at + size):
+                first = (offset + start) // length
+                last = (offset + end - 1) // length
+                data[first:last + 1] = b'\x01' * (last - first + 1)
+
+        return set(i for i in pieces if not data[i])
+
+    def _file_stats(self):
+        stats = []
+        for f, path in enumerate(self._files):
+            if path is None or f in self._parted:
+                stats.append((0, 0))
+            else:
+                stat = os.stat(path)
+                stats.append((stat.st_size, stat.st_mtime_ns))
+
+        return stats
+
+    # Sets the pieces we have from the fast-resume data, and returns the
+    # pieces which still need to be checked. Returns None if there is no
+    # usable resume data.
+    def _load_resume(self):
+        if self._resume_path is None:
+            return None
+
+        torrent = self._torrent
+        try:
+            with open(self._resume_path, 'rb') as f:
+                resume = schema.decode(f.read(), _Resume)
+
+            haves = bitfield.unpack(resume.haves, torrent.number_of_pieces)
+        except (IOError, OSError):
+            return None
+        except (BencodeError, ValueError) as err:
+            _logger.info("Ignoring resume data %s, %s" % \
+                             (self._resume_path, err))
+            return None
+
+        if resume.info_hash != torrent.info_hash or \
+                len(resume.files) != len(self._files):
+            _logger.info("Resume data %s is for another torrent" % \
+                             self._resume_path)
+            return None
+
+        check = set(p for p in resume.in_progress \
+                        if 0 <= p < torrent.number_of_pieces)
+
+        stats = self._file_stats()
+        for f, entry in enumerate(resume.files):
+            if (entry.size, entry.mtime) == stats[f] or \
+                    torrent.file_size(f) == 0:
+                continue
+
+            _logger.info("File %d changed since resume data was saved" % f)
+            start = torrent.file_offset(f)
+            end = start + torrent.file_size(f)
+            check.update(range(start // torrent.piece_length, \
+                                   (end - 1) // torrent.piece_length + 1))
+
+        for i in range(torrent.number_of_pieces):
+            if not i in check:
+                self._haves.set(i, haves.get(i))
+
+        for partial in resume.partial:
+            index = partial.piece
+            if 0 <= index < torrent.number_of_pieces and \
+                    not index in check and not self._haves.get(index):
+                self._partial[index] = partial.blocks
+
+        return sorted(check)
+
+    # Writes the fast-resume data, the pieces are only trusted as long
+    # as the files are not modified after this
+    def save_resume(self):
+        if self._resume_path is None:
+            return
+
+        content = bencoder.encode({
+            'info hash': self._torrent.info_hash,
+            'haves': self._haves.pack(),
+            'in progress': sorted(self._writing | self._pending),
+            'files': [{'size': size, 'mtime': mtime} \
+                          for size, mtime in self._file_stats()],
+            'partial': [{'piece': index, 'blocks': blocks} \
+                            for index, blocks in sorted(self._partial.items())]
+        })
+
+        temp = self._resume_path + '.tmp'
+        with open(temp, 'wb') as f:
+            f.write(content)
+        os.replace(temp, self._resume_path)
 
-    def _start(self, index):
-        off = self._torrent.piece_length * index
-        f = 0
-        size = self._torrent.file_size(f)
+        self._resume_saved = time.time()
 
-        while off >= size:
-            off -= size
-            f += 1
-            size = self._torrent.file_size(f)
+    def _close_files(self):
+        for path in self._files:
+            if not path is None:
+                self._pool.close(path)
 
-        return f, off, size
+        self._pool.close(self._part_path)
 
     @property
     def bitfield(self):
         return self._haves
 
+    @property
+    def torrent(self):
+        return self._torrent
+
+    # Checks the pending pieces (or the given pieces) in the background
+    # with a recheck.Recheck, see there for the arguments
+    def recheck(self, pieces = None, workers = None, rate = None, \
+                    callback = None, slots = None, done = None):
+        if pieces is None:
+            pieces = list(self._pending)
+
+        check = recheck.Recheck(self, pieces, workers, rate, callback, \
+                                    slots = slots, done = done)
+        self._checks.append(check)
+        check.start()
+        return check
+
+    # Checks the pieces we have again every interval seconds (by
+    # default recheck.SCRUB_INTERVAL)
+    def scrub(self, interval = None, workers = None, rate = None, \
+                  callback = None):
+        self._scrub = (interval, workers, rate, callback)
+        check = recheck.Recheck(self, None, workers, rate, callback, \
+                                    interval or recheck.SCRUB_INTERVAL)
+        self._checks.append(check)
+        check.start()
+        return check
+
+    def check_piece(self, index):
+        return self._piece(index).valid()
+
+    # Called with the result of checking a piece. Returns true if the
+    # piece was pending or if it was found to be corrupted.
+    def piece_checked(self, index, valid):
+        pending = index in self._pending
+        self._pending.discard(index)
+
+        had = self._haves.get(index)
+        self._haves.set(index, valid)
+        if valid:
+            self._partial.pop(index, None)
+        else:
+            self._cache.discard((self._torrent.info_hash, index))
+
+        return pending or had != valid
+
+    # The piece is waiting to be checked
+    def checking(self, index):
+        return index in self._pending
+
+    # All pieces have been checked
+    def checked(self):
+        return not self._pending
+
+    def pieces(self):
+        return [i for i in range(self._torrent.number_of_pieces) \
+                    if self._haves.get(i)]
+
     def halt(self):
+        self._halt_checks()
+
+        if not self._io is None:
+            self._io.drain()
+
+        try:
+            self.save_resume()
+        except (IOError, OSError) as err:
+            _logger.error("Could not save resume data, with %s" % err)
+
+        self._close_files()
+
+    # Stops checking and closes the files without saving resume data,
+    # for a storage which is dropped (e.g. a second one of a torrent
+    # already running, whose resume data would be overwritten)
+    def discard(self):
+        self._halt_checks()
         self._close_files()
 
+    def _halt_checks(self):
+        for check in self._checks:
+            check.halt()
+            if check.is_alive() and check != threading.current_thread():
+                check.join()
+
+        self._checks = []
+
+    # Stops checking, closes the files and drops the cached pieces, only
+    # the pieces we have are kept. Files are opened again on demand,
+    # scrubbing is restarted by wake.
+    def hibernate(self):
+        self.halt()
+        self._cache.discard_torrent(self._torrent.info_hash)
+
+    def wake(self):
+        if not self._scrub is None:
+            self.scrub(*self._scrub)
+
+    def _piece_priority_table(self):
+        torrent = self._torrent
+        length = torrent.piece_length
+        priorities = bytearray(torrent.number_of_pieces)
+
+        for f, priority in enumerate(self._file_priorities):
+            if torrent.file_size(f) == 0 or torrent.is_pad_file(f):
+                continue
+
+            start = torrent.file_offset(f)
+            first = start // length
+            last = (start + torrent.file_size(f) - 1) // length
+
+            # Pieces only within the file, then the ones it shares
+            if last - first > 1:
+                priorities[first + 1:last] = bytes([priority]) * \
+                    (last - first - 1)
+            for i in set((first, last)):
+                priorities[i] = max(priorities[i], priority)
+
+        for i, priority in self._piece_priorities.items():
+            priorities[i] = priority
+
+        return priorities
+
+    def file_priority(self, f):
+        return self._file_priorities[f]
+
+    def piece_priority(self, index):
+        return self._priorities[index]
+
+    # Priority set for the piece itself, None if it has the one of its
+    # files
+    def own_piece_priority(self, index):
+        return self._piece_priorities.get(index, None)
+
+    def wanted(self, index):
+        return self._priorities[index] != PRIORITY_SKIP
+
+    # Sets the priority of file f. A skipped file which becomes wanted
+    # is created, with its parts from the part file. Returns the pieces
+    # which became wanted, the ones we don't have are checked in the
+    # background first (see recheck, callback is given to it).
+    def set_file_priority(self, f, priority, callback = None):
+        self._file_priorities[f] = priority
+        if f in self._parted and priority != PRIORITY_SKIP:
+            self._parted.discard(f)
+            self._open_file(f)
+            if not self._parted:
+                self._remove_part_file()
+
+        return self._reprioritize(callback)
+
+    # Sets the priority of the piece, None for the one of its files
+    def set_piece_priority(self, index, priority, callback = None):
+        return self.set_piece_priorities({index: priority}, callback)
+
+    # Sets the priorities of several pieces at once (a dictionary of
+    # piece index to priority or None), see set_piece_priority
+    def set_piece_priorities(self, priorities, callback = None):
+        for index, priority in priorities.items():
+            if priority is None:
+                self._piece_priorities.pop(index, None)
+            else:
+                self._piece_priorities[index] = priority
+
+        return self._reprioritize(callback)
+
+    def _reprioritize(self, callback):
+        before = self._priorities
+        self._priorities = self._piece_priority_table()
+
+        wanted = [i for i, p in enumerate(self._priorities) \
+                      if p != PRIORITY_SKIP and before[i] == PRIORITY_SKIP]
+
+        check = [i for i in wanted if not self._haves.get(i) and \
+                     not i in self._pending]
+        holes = self._holes(check)
+        check = [i for i in check if not i in holes]
+        if check:
+            self._pending.update(check)
+            self.recheck(check, callback = callback)
+
+        return wanted
+
     def has(self, index):
         return self._haves.get(int(index))
 
@@ -99,46 +691,213 @@ class Storage(object):
             
         return result
 
+    # Bytes of the wanted pieces we don't have
     def missing(self):
-        return self._torrent.length - self.size()
+        return sum(self._torrent.piece_size(i) \
+                       for i in range(self._torrent.number_of_pieces) \
+                       if self._priorities[i] != PRIORITY_SKIP and \
+                       not self._haves.get(i))
 
     def write_piece(self, piece):
         if not piece.valid():
             return False
 
-        f, off, size = self._start(piece.index)
-        written = 0
-        
+        self._writing.add(piece.index)
+
         block_index = 0
-        while written < piece.length:
-            need = piece.length - written
-            length = need if off + need < size else size - off
-            
-            fio = self._files[f]
-            fio.seek(off)
-            fio.write(piece.block(block_index, length))
-            fio.flush()
+        for f, off, length in self._torrent.piece_spans(piece.index):
+            if self._files[f] is None:
+                block_index += length
+                continue
+
+            path, off = self._location(f, off)
+            # Positional writes, the file may be used concurrently
+            with self._pool.file(path) as fio:
+                _pwrite(fio.fileno(), piece.block(block_index, length), off)
 
-            written += length
             block_index += length
-            if need - length > 0:
-                f += 1
-                off = 0
-                size = self._torrent.file_size(f)
 
+        self._written(piece)
+        return True
+
+    def _written(self, piece):
         self._haves.set(piece.index, True)
+        self._writing.discard(piece.index)
+        self._partial.pop(piece.index, None)
+
+        if time.time() - self._resume_saved > RESUME_INTERVAL:
+            self.save_resume()
+
+    # Queues the piece to be written. Returns false if the piece is not
+    # valid, otherwise callback(piece, error) is called once the piece
+    # has been written, error is None if writing succeeded. Without
+    # disk I/O the piece is written before returning.
+    def write_piece_async(self, piece, callback):
+        if self._io is None:
+            error = None
+            try:
+                if not self.write_piece(piece):
+                    return False
+            except (IOError, OSError) as err:
+                error = err
+
+            callback(piece, error)
+            return True
+
+        if not piece.valid():
+            return False
+
+        self._writing.add(piece.index)
+
+        writes = []
+        block_index = 0
+        for f, off, length in self._torrent.piece_spans(piece.index):
+            if not self._files[f] is None:
+                path, at = self._location(f, off)
+                writes.append((path, at, piece.block(block_index, length)))
+            block_index += length
+
+        left = [len(writes)]
+        errors = []
+        lock = threading.Lock()
+
+        def written(error):
+            with lock:
+                left[0] -= 1
+                if not error is None:
+                    errors.append(error)
+                if left[0] > 0:
+                    return
+
+            if errors:
+                self._write_failed(piece)
+                callback(piece, errors[0])
+            else:
+                self._written(piece)
+                callback(piece, None)
+
+        if not writes:
+            left[0] = 1
+            written(None)
+
+        for path, off, data in writes:
+            self._io.write(path, off, data, written)
+
         return True
 
+    def _write_failed(self, piece):
+        self._writing.discard(piece.index)
+
+    # Writes the blocks at the given offsets of a piece being downloaded
+    # in place, without having the piece, and keeps which blocks they
+    # are in the fast-resume data. After a restart partial_piece gives
+    # the piece back with these blocks set.
+    def save_partial(self, piece, offsets):
+        blocks = bitfield.Bitfield(\
+            (piece.length + merkle.BLOCK_SIZE - 1) // merkle.BLOCK_SIZE)
+        for offset in offsets:
+            self._write_range(piece, offset, \
+                                  min(merkle.BLOCK_SIZE, piece.length - offset))
+            blocks.set(offset // merkle.BLOCK_SIZE)
+
+        self._partial[piece.index] = blocks.pack()
+
+    # Writes length bytes of the piece from offset start to the files
+    def _write_range(self, piece, start, length):
+        end = start + length
+        position = 0
+        for f, off, size in self._torrent.piece_spans(piece.index):
+            low, high = max(start, position), min(end, position + size)
+            if low < high and not self._files[f] is None:
+                path, at = self._location(f, off + low - position)
+                with self._pool.file(path) as fio:
+                    _pwrite(fio.fileno(), piece.block(low, high - low), at)
+
+            position += size
+
+    # Pieces with blocks saved by save_partial
+    def partial_pieces(self):
+        return sorted(self._partial)
+
+    # Bytes of the blocks given back by partial_piece, which would
+    # otherwise have been downloaded again
+    @property
+    def resumed_bytes(self):
+        return self._resumed
+
+    # Returns a piece from empty_piece with the blocks saved by
+    # save_partial set, and the offsets of those blocks
+    def partial_piece(self, index):
+        piece = self.empty_piece(index)
+        count = (piece.length + merkle.BLOCK_SIZE - 1) // merkle.BLOCK_SIZE
+        packed = self._partial.get(index, b'')
+        if len(packed) * 8 < count:
+            return piece, []
+
+        blocks = bitfield.unpack(packed, count)
+        data = self._piece(index).data
+
+        offsets = []
+        for b in range(count):
+            if not blocks.get(b):
+                continue
+
+            offset = b * merkle.BLOCK_SIZE
+            length = min(merkle.BLOCK_SIZE, piece.length - offset)
+            if piece.set_block(offset, data[offset:offset + length]):
+                offsets.append(offset)
+                self._resumed += length
+
+        return piece, offsets
+
     def piece(self, index):        
         if not self._haves.get(index):
             raise IndexError("Don't have piece %d" % index)
 
         return self._piece(index)
 
+    # Reads a block of a piece we have, through the piece cache
+    def read_block(self, index, offset, length):
+        if not self._haves.get(index):
+            raise IndexError("Don't have piece %d" % index)
+
+        key = (self._torrent.info_hash, index)
+        data = self._cache.get(key)
+        if data is None:
+            data = self._piece(index).data
+            self._cache.put(key, data)
+
+        if not 0 <= offset <= offset + length <= len(data):
+            raise IndexError("Invalid offset (" + str(offset) + \
+                                 ") and/or length (" + str(length) + ")")
+
+        return memoryview(data)[offset:offset + length]
+
+    # Reads the block on a disk I/O thread unless it is cached, then
+    # calls callback(block, error)
+    def read_block_async(self, index, offset, length, callback):
+        data = None
+        if not self._io is None:
+            data = self._cache.get((self._torrent.info_hash, index))
+
+        if self._io is None or not data is None:
+            block, error = None, None
+            try:
+                block = self.read_block(index, offset, length)
+            except (IOError, OSError, IndexError) as err:
+                error = err
+
+            callback(block, error)
+            return
+
+        self._io.call(lambda: self.read_block(index, offset, length), \
+                          callback)
+
     def empty_piece(self, index):
         return Piece.create_empty_piece(\
             index, self._torrent.piece_size(index), \
-                self._torrent.piece_hash(index))
+                self._torrent.piece_hash(index), \
+                self._torrent.piece_merkle(index))
 
     def _piece(self, index):
         #if not self._haves.get(index):
@@ -146,48 +905,287 @@ class Storage(object):
         #        index, self._torrent.piece_size(index), \
         #            self._torrent.piece_hash(index))
 
-        f, off, size = self._start(index)
-        
         content = []
-        read = 0
-        piece_size = self._torrent.piece_size(index)
-
-        while read < piece_size:
-            need = piece_size - read
-            length = need if off + need < size else size - off
-
-            fio = self._files[f]
-            fio.seek(off)
-            content.append(fio.read(length))
+        for f, off, length in self._torrent.piece_spans(index):
+            if self._files[f] is None:
+                content.append(bytes(length))
+                continue
 
-            read += length
-            if need - length > 0:
-                f += 1
-                size = self._torrent.file_size(f)
-                off = 0
+            path, off = self._location(f, off)
+            # Positional reads, pieces may be read concurrently
+            with self._pool.file(path) as fio:
+                content.append(os.pread(fio.fileno(), length, off))
 
         piece = Piece(index, b''.join(content), \
-                      self._torrent.piece_hash(index))
+                      self._torrent.piece_hash(index), \
+                      self._torrent.piece_merkle(index))
 
         return piece
 
 
-@utils.synchronize('write_piece', 'piece')
+@utils.synchronize('write_piece', 'piece', 'save_resume', 'piece_checked', \
+                       'write_piece_async', '_written', '_write_failed', \
+                       'set_file_priority', 'set_piece_priorities', \
+                       'save_partial')
 class SynchronizedStorage(Storage, metaclass = utils.SynchronizedClass):
     pass
 
 
+# Locks on byte ranges, overlapping ranges are held one at a time
+class RangeLock(object):
+    def __init__(self):
+        self._ranges = []
+        self._released = threading.Condition()
+
+    def _overlaps(self, start, end):
+        return any(s < end and start < e for s, e in self._ranges)
+
+    @contextlib.contextmanager
+    def locked(self, start, end):
+        with self._released:
+            while self._overlaps(start, end):
+                self._released.wait()
+            self._ranges.append((start, end))
+
+        try:
+            yield
+        finally:
+            with self._released:
+                self._ranges.remove((start, end))
+                self._released.notify_all()
+
+
+# Storage safe to use from many threads without one lock around every
+# call. All disk I/O is positional, so reads run in parallel, and
+# writes only wait for writes to overlapping ranges of the torrent. A
+# lock is only held to update which pieces we have.
+class ConcurrentStorage(Storage):
+    def __init__(self, *args, **kwargs):
+        self._ranges = RangeLock()
+        self._state = threading.RLock()
+
+        super(ConcurrentStorage, self).__init__(*args, **kwargs)
+
+    def write_piece(self, piece):
+        start = piece.index * self._torrent.piece_length
+        with self._ranges.locked(start, start + piece.length):
+            return super(ConcurrentStorage, self).write_piece(piece)
+
+    def _written(self, piece):
+        with self._state:
+            super(ConcurrentStorage, self)._written(piece)
+
+    def piece_checked(self, index, valid):
+        with self._state:
+            return super(ConcurrentStorage, self).piece_checked(index, valid)
+
+    def save_resume(self):
+        with self._state:
+            super(ConcurrentStorage, self).save_resume()
+
+    def set_file_priority(self, f, priority, callback = None):
+        with self._state:
+            return super(ConcurrentStorage, self).set_file_priority(\
+                f, priority, callback)
+
+    def save_partial(self, piece, offsets):
+        with self._state:
+            super(ConcurrentStorage, self).save_partial(piece, offsets)
+
+    def set_piece_priorities(self, priorities, callback = None):
+        with self._state:
+            return super(ConcurrentStorage, self).set_piece_priorities(\
+                priorities, callback)
+
+
+# Storage with every file memory-mapped. Pieces within one file are
+# memoryview slices of the mapping: blocks are served to peers without
+# copying, and pieces being downloaded (see empty_piece) have their
+# blocks written straight into the mapping. Files are extended to their
+# full size when they are mapped. Every mapping holds a file descriptor
+# of its own, outside of the file pool.
+class MmapStorage(Storage):
+    def __init__(self, torrent, root_dir = DEFAULT_ROOT_DIR, resume = True, \
+                     background = False, cache = None, file_pool = None, \
+                     disk_io = None, preallocate = PREALLOCATE_NONE, \
+                     file_priorities = None):
+        # File index => (mmap, memoryview of it)
+        self._maps = {}
+        self._map_lock = threading.Lock()
+
+        # Writes only copy into the mapping, the kernel writes back
+        super(MmapStorage, self).__init__(torrent, root_dir, resume, \
+            background, cache, file_pool, preallocate = preallocate, \
+            file_priorities = file_priorities)
+
+    def _map(self, f):
+        with self._map_lock:
+            if not f in self._maps:
+                size = self._torrent.file_size(f)
+                with self._pool.file(self._files[f]) as fio:
+                    fileno = fio.fileno()
+                    if os.fstat(fileno).st_size < size:
+                        os.ftruncate(fileno, size)
+
+                    mapping = mmap.mmap(fileno, size)
+
+                self._maps[f] = (mapping, memoryview(mapping))
+
+            return self._maps[f]
+
+    # The view of the piece in the mapping, if the piece is within one
+    # file, otherwise None
+    def _view(self, index):
+        spans = self._torrent.piece_spans(index)
+        if len(spans) != 1 or self._files[spans[0][0]] is None or \
+                spans[0][0] in self._parted:
+            return None
+
+        f, off, length = spans[0]
+        mapping, view = self._map(f)
+        return view[off:off + length]
+
+    def _close_files(self):
+        with self._map_lock:
+            for mapping, view in self._maps.values():
+                try:
+                    view.release()
+                    mapping.close()
+                except BufferError:
+                    # Blocks are still referenced (e.g. queued PIECE
+                    # messages), the mapping is closed once they are gone
+                    pass
+
+            self._maps = {}
+
+        super(MmapStorage, self)._close_files()
+
+    def save_resume(self):
+        with self._map_lock:
+            for mapping, view in self._maps.values():
+                mapping.flush()
+
+        super(MmapStorage, self).save_resume()
+
+    def write_piece(self, piece):
+        if not piece.valid():
+            return False
+
+        self._writing.add(piece.index)
+
+        block_index = 0
+        for f, off, length in self._torrent.piece_spans(piece.index):
+            if self._files[f] is None:
+                block_index += length
+                continue
+
+            # Files in the part file are not mapped
+            if f in self._parted:
+                path, at = self._location(f, off)
+                with self._pool.file(path) as fio:
+                    _pwrite(fio.fileno(), piece.block(block_index, length), at)
+
+                block_index += length
+                continue
+
+            mapping, view = self._map(f)
+            # Pieces from empty_piece are already in place
+            data = piece.data
+            if not (isinstance(data, memoryview) and data.obj is mapping):
+                view[off:off + length] = piece.block(block_index, length)
+
+            block_index += length
+
+        self._written(piece)
+        return True
+
+    def _write_range(self, piece, start, length):
+        # Pieces from empty_piece are already in place
+        view = self._view(piece.index)
+        data = piece.data
+        if view is None or not (isinstance(data, memoryview) and \
+                                    data.obj is view.obj):
+            super(MmapStorage, self)._write_range(piece, start, length)
+
+    # Blocks are served from the mapping, the page cache is the cache
+    def read_block(self, index, offset, length):
+        return self.piece(index).block(offset, length)
+
+    def empty_piece(self, index):
+        view = self._view(index)
+        if view is None:
+            return super(MmapStorage, self).empty_piece(index)
+
+        return Piece(index, view, self._torrent.piece_hash(index), \
+                         self._torrent.piece_merkle(index))
+
+    def _piece(self, index):
+        view = self._view(index)
+        if view is None:
+            content = []
+            for f, off, length in self._torrent.piece_spans(index):
+                if self._files[f] is None:
+                    content.append(bytes(length))
+                elif f in self._parted:
+                    path, at = self._location(f, off)
+                    with self._pool.file(path) as fio:
+                        content.append(os.pread(fio.fileno(), length, at))
+                else:
+                    mapping, v = self._map(f)
+                    content.append(v[off:off + length])
+
+            view = b''.join(content)
+
+        return Piece(index, view, self._torrent.piece_hash(index), \
+                         self._torrent.piece_merkle(index))
+
+
+@utils.synchronize('write_piece', 'piece', 'save_resume', 'piece_checked', \
+                       'write_piece_async', '_written', '_write_failed', \
+                       'set_file_priority', 'set_piece_priorities', \
+                       'save_partial')
+class SynchronizedMmapStorage(MmapStorage, \
+                                  metaclass = utils.SynchronizedClass):
+    pass
+
+
+# A piece is checked against its SHA1 hash (v1 torrents), against the
+# merkle tree of its file (v2 torrents) or both (hybrid torrents). With
+# a merkle tree each 16 KiB block is hashed when it is set, so a bad
+# piece can be narrowed down to the blocks which were corrupted once
+# the leaf hashes are known (see set_leaves and bad_blocks).
+#
+# Blocks are written in place, pieces being downloaded are preallocated
+# bytearrays (or writable views, see MmapStorage.empty_piece), so
+# assembling a piece copies every byte once. The SHA1 of the piece is
+# updated whenever the blocks received so far extend the contiguous
+# prefix, so little is left to hash once the last block arrives.
 class Piece(object):
     @classmethod
-    def create_empty_piece(cls, index, length, hash):
-        return Piece(index, b'\x00' * length, hash)
+    def create_empty_piece(cls, index, length, hash, merkle = None):
+        return Piece(index, bytearray(length), hash, merkle)
 
-    def __init__(self, index, data, hash):
+    def __init__(self, index, data, hash, merkle = None):
         self._index = index
         self._length = len(data)
         self._data = data
         self._hash = hash
 
+        # torrent.MerklePiece or None
+        self._merkle = merkle
+        # Block offset => leaf hash, of the blocks set so far
+        self._leaves = {}
+        # Trusted leaf hashes of the piece, if known
+        self._trusted = None
+
+        # Running SHA1 of the first _hashed bytes, and the end of every
+        # block set, by offset
+        self._sha1 = hashlib.sha1()
+        self._hashed = 0
+        self._received = {}
+        # Result of valid, until a block is set
+        self._valid = None
+
     @property
     def index(self):
         return self._index
@@ -200,6 +1198,10 @@ class Piece(object):
     def data(self):
         return self._data
 
+    @property
+    def merkle(self):
+        return self._merkle
+
     def __eq__(self, other):
         try:
             return self._index == int(other)
@@ -213,24 +1215,339 @@ class Piece(object):
         return "Piece:[index=" + str(self._index) + \
             ", length=" + str(self._length) + "]"
   
+    # The block as a memoryview of the piece, without copying it
     def block(self, index, length):
         if 0 <= index <= index + length <= self._length:
-            return self._data[index:index + length]
+            return memoryview(self._data)[index:index + length]
         else:
             raise IndexError("Invalid index (" + str(index) + \
                                  ") and/or length (" + str(length) + ")")
 
+    # Returns false, leaving the piece unchanged, if the leaf hashes of
+    # the piece are known and the block does not match them
     def set_block(self, index, data):
         length = len(data)
-        if 0 <= index and index + length <= self._length:
-            self._data = self._data[0:index] + data + \
-                self._data[index + length:self._length]
-        else:
+        if not (0 <= index and index + length <= self._length):
             raise IndexError("Invalid index and/or data length")
 
+        if not self._merkle is None and not self._trusted is None and \
+                index % merkle.BLOCK_SIZE == 0:
+            view = memoryview(data)
+            end = min(length, self._merkle.length - index)
+            for block in range(0, end, merkle.BLOCK_SIZE):
+                leaf = merkle.block_hash(\
+                    view[block:min(block + merkle.BLOCK_SIZE, end)])
+                if leaf != self._trusted_leaf(index + block):
+                    return False
+
+        if not (isinstance(self._data, bytearray) or \
+                    (isinstance(self._data, memoryview) and \
+                         not self._data.readonly)):
+            # Immutable data is copied once, then written in place
+            self._data = bytearray(self._data)
+
+        self._data[index:index + length] = data
+        self._valid = None
+
+        if not self._merkle is None:
+            self._hash_blocks(index, length)
+
+        if not self._hash is None:
+            self._update_sha1(index, length)
+
+        return True
+
+    def _update_sha1(self, index, length):
+        if index < self._hashed:
+            # A block already hashed has been replaced
+            self._sha1 = hashlib.sha1()
+            self._hashed = 0
+
+        self._received[index] = max(index + length, \
+                                        self._received.get(index, 0))
+
+        view = memoryview(self._data)
+        start = self._hashed
+        while self._hashed in self._received and \
+                self._received[self._hashed] > self._hashed:
+            end = self._received[self._hashed]
+            self._sha1.update(view[self._hashed:end])
+            self._hashed = end
+
+        _count_hashed('incremental', self._hashed - start)
+
+    def _hash_blocks(self, index, length):
+        end = min(index + length, self._merkle.length)
+        block = index - index % merkle.BLOCK_SIZE
+        view = memoryview(self._data)
+
+        while block < end:
+            block_end = min(block + merkle.BLOCK_SIZE, self._merkle.length)
+            self._leaves[block] = merkle.block_hash(view[block:block_end])
+            block = block_end
+
+    def _trusted_leaf(self, block):
+        if self._trusted is None:
+            return None
+
+        return self._trusted[block // merkle.BLOCK_SIZE]
+
+    def leaf_hashes(self):
+        result = []
+        for block in range(0, self._merkle.length, merkle.BLOCK_SIZE):
+            if not block in self._leaves:
+                self._hash_blocks(block, 1)
+            result.append(self._leaves[block])
+
+        return result
+
+    # Sets the leaf hashes of the piece, they must hash up to the
+    # expected root of the piece. Returns false if they don't.
+    def set_leaves(self, leaves):
+        if merkle.root(leaves, self._merkle.leaf_count) != \
+                self._merkle.expected:
+            return False
+
+        self._trusted = list(leaves)
+        return True
+
+    # Offsets of the blocks which don't match the trusted leaf hashes
+    def bad_blocks(self):
+        return [block for block, leaf in \
+                    zip(range(0, self._merkle.length, merkle.BLOCK_SIZE), \
+                            self.leaf_hashes()) \
+                    if leaf != self._trusted_leaf(block)]
+
     def valid(self):
-        hashed = hashlib.sha1(self._data).digest()
-        return hashed == self._hash
+        if self._valid is None:
+            self._valid = self._check()
+
+        return self._valid
+
+    def _check(self):
+        if not self._merkle is None:
+            # Bytes after the end of the file are padding
+            if self._length < self._merkle.length or \
+                    self._data[self._merkle.length:] != \
+                    bytes(self._length - self._merkle.length):
+                return False
+
+            if merkle.root(self.leaf_hashes(), self._merkle.leaf_count) != \
+                    self._merkle.expected:
+                return False
+
+            if self._hash is None:
+                return True
+
+        sha1 = self._sha1.copy()
+        if self._hashed < self._length:
+            sha1.update(memoryview(self._data)[self._hashed:])
+            if self._received:
+                _count_hashed('completion', self._length - self._hashed)
+
+        return sha1.digest() == self._hash
+
+def _benchmark(number_of_files = 32, file_size = 4 * 1024 * 1024):
+    import tempfile
+    import shutil
+    import torrent
+
+    directory = tempfile.mkdtemp()
+    data = os.path.join(directory, 'data')
+    os.makedirs(data)
+    for f in range(number_of_files):
+        with open(os.path.join(data, 'file%d' % f), 'wb') as out:
+            out.write(os.urandom(file_size))
+
+    meta = torrent.Torrent(torrent.dir_to_torrent(\
+            data, 'http://tracker/announce', piece_length = 256 * 1024))
+
+    def timed(resume):
+        start = time.perf_counter()
+        store = Storage(meta, directory, resume)
+        elapsed = time.perf_counter() - start
+        assert store.completed()
+        store.halt()
+        return elapsed
+
+    print("%d files of %d bytes, %d pieces" % \
+              (number_of_files, file_size, meta.number_of_pieces))
+    print(" - full check        %.3f s" % timed(False))
+    timed(True)
+    print(" - resume data       %.3f s" % timed(True))
+
+    # Touching a file only rechecks its pieces
+    os.utime(os.path.join(data, 'file0'))
+    print(" - one file changed  %.3f s" % timed(True))
+
+    shutil.rmtree(directory)
+
+    # Assembling a 16 MiB piece from 16 KiB blocks, in place and by
+    # concatenation as pieces used to be
+    length = 16 * 1024 * 1024
+    block = os.urandom(16384)
+
+    start = time.perf_counter()
+    piece = Piece.create_empty_piece(0, length, None)
+    for offset in range(0, length, len(block)):
+        piece.set_block(offset, block)
+    in_place = time.perf_counter() - start
+
+    start = time.perf_counter()
+    data = b'\x00' * length
+    for offset in range(0, length, len(block)):
+        data = data[0:offset] + block + data[offset + len(block):length]
+    concatenated = time.perf_counter() - start
+
+    print("16 MiB piece from 16 KiB blocks")
+    print(" - in place          %.3f s" % in_place)
+    print(" - concatenated      %.3f s" % concatenated)
+
+    # Checking the piece once the last block has arrived
+    hash = hashlib.sha1(data).digest()
+    piece = Piece.create_empty_piece(0, length, hash)
+    for offset in range(0, length, len(block)):
+        piece.set_block(offset, block)
+
+    start = time.perf_counter()
+    assert piece.valid()
+    incremental = time.perf_counter() - start
+
+    start = time.perf_counter()
+    assert Piece(0, data, hash).valid()
+    whole = time.perf_counter() - start
+
+    print("Check after the last block")
+    print(" - incremental SHA1  %.4f s" % incremental)
+    print(" - whole piece SHA1  %.4f s" % whole)
+    print(hash_counters())
+
+# Opening a new torrent of the given size, the files are holes so no
+# piece is read. For comparison a small sparse file is hashed in full.
+def _open_benchmark(size = 100 * 2 ** 30, compare = 256 * 2 ** 20, \
+                        piece_length = 2 ** 20):
+    import tempfile
+    import shutil
+    import torrent
+
+    def fresh(length):
+        pieces = os.urandom(20) * (length // piece_length)
+        return torrent.Torrent.from_metadata(os.urandom(20), \
+            'http://tracker/announce', None, 'fresh', piece_length, \
+            pieces, [['a'], ['b']], [length // 2, length // 2], False)
+
+    print("Opening a new %d GiB torrent" % (size // 2 ** 30))
+    for preallocate in (PREALLOCATE_NONE, PREALLOCATE_SPARSE):
+        directory = tempfile.mkdtemp()
+        start = time.perf_counter()
+        store = Storage(fresh(size), directory, resume = False, \
+                            preallocate = preallocate)
+        print(" - preallocate %-6s %.3f s, %d pieces missing" % \
+                  (preallocate, time.perf_counter() - start, \
+                       store.torrent.number_of_pieces - len(store.pieces())))
+        store.halt()
+        shutil.rmtree(directory)
+
+    directory = tempfile.mkdtemp()
+    store = Storage(fresh(compare), directory, resume = False, \
+                        preallocate = PREALLOCATE_SPARSE)
+    pieces = range(store.torrent.number_of_pieces)
+    start = time.perf_counter()
+    recheck.Recheck(store, pieces).check(pieces)
+    elapsed = time.perf_counter() - start
+    print(" - hashing the holes of %d MiB %.3f s (%.0f s for %d GiB)" % \
+              (compare // 2 ** 20, elapsed, elapsed * size / compare, \
+                   size // 2 ** 30))
+    store.halt()
+    shutil.rmtree(directory)
+
+# Reading every piece from a number of threads at once, with the
+# storage lock of SynchronizedStorage and without it
+# The storage as it was before positional I/O, for _read_benchmark:
+# blocks are read with seek and read on file objects shared by all
+# threads, under the object lock
+@utils.synchronize('read_block')
+class _SeekReadStorage(SynchronizedStorage):
+    def _piece(self, index):
+        content = []
+        for f, off, length in self._torrent.piece_spans(index):
+            with self._pool.file(self._files[f]) as fio:
+                fio.seek(off)
+                content.append(fio.read(length))
+
+        return Piece(index, b''.join(content), \
+                         self._torrent.piece_hash(index), \
+                         self._torrent.piece_merkle(index))
+
+# Uploads of blocks to many peers at once: the threads share the
+# pieces and ask for one block of each of theirs, in random order,
+# through read_block with the piece cache disabled, so every block is
+# read from the file. The
+# file is read from the page cache, then from the disk (its pages are
+# dropped before every run, where posix_fadvise is available), where
+# reading in parallel overlaps the waits on the disk.
+def _read_benchmark(size = 256 * 1024 * 1024, threads = (1, 2, 8, 30)):
+    import random
+    import tempfile
+    import shutil
+    import torrent
+
+    directory = tempfile.mkdtemp()
+    data = os.path.join(directory, 'data')
+    with open(data, 'wb') as out:
+        out.write(os.urandom(size))
+
+    meta = torrent.Torrent(torrent.file_to_torrent(\
+            data, 'http://tracker/announce', piece_length = 256 * 1024))
+
+    def drop_pages():
+        fd = os.open(data, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+    def upload(store, count, cold):
+        def peer(order):
+            for index in order:
+                store.read_block(index, 16384, 16384)
+
+        pieces = random.sample(range(meta.number_of_pieces), \
+                                   meta.number_of_pieces)
+        orders = [pieces[i::count] for i in range(count)]
+        peers = [threading.Thread(target = peer, args = (order,)) \
+                     for order in orders]
+        if cold:
+            drop_pages()
+
+        start = time.perf_counter()
+        for p in peers:
+            p.start()
+        for p in peers:
+            p.join()
+
+        return meta.number_of_pieces / (time.perf_counter() - start)
+
+    print("Uploading a block of each of %d pieces" % meta.number_of_pieces)
+    for cold in (False, True):
+        if cold and not hasattr(os, 'posix_fadvise'):
+            break
+
+        print("From the %s" % ('disk' if cold else 'page cache'))
+        results = {}
+        for cls in (_SeekReadStorage, SynchronizedStorage, \
+                        ConcurrentStorage):
+            store = cls(meta, directory, resume = False, \
+                            cache = PieceCache(0))
+            for count in threads:
+                rate = upload(store, count, cold)
+                results[(cls, count)] = rate
+                print(" - %-20s %2d threads %8.0f blocks/s (x%.2f)" % \
+                          (cls.__name__, count, rate, \
+                               rate / results[(_SeekReadStorage, count)]))
+            store.halt()
+
+    shutil.rmtree(directory)
 
 if __name__ == '__main__':
     import torrent
@@ -251,3 +1568,7 @@ if __name__ == '__main__':
     print(storage._haves)
 
     storage._close_files()
+
+    _benchmark()
+    _read_benchmark()
+    _open_benchmark()
@@ -1,37 +1,272 @@
-import bencode.bdecoder as bdecoder
+import bencode.schema as schema
+import bencode.lazy as lazy
 import bencode.bencoder as bencoder
+from bencode.bencode_error import BencodeError
 
 import hashlib
 import time
 import os.path as path
 import os
 import copy
+import bisect
+import collections
+import threading
+import concurrent.futures
+import array
+import sys
 
-_PIECE_LENGTH = 524288 #bytes 8-10GB else 262144?
-
-def hash_file_pieces(file_list, length):
-    hashes = []
-    piece = b''
+import bitfield
+import merkle
 
-    for f in range(len(file_list)):
-        with open(file_list[f], 'rb') as fio:
-            piece += fio.read(length - len(piece))
-            while piece:
-                if len(piece) < length:
-                    break
-
-                hash = hashlib.sha1(piece)
-                hashes.append(hash.digest()) 
-                piece = fio.read(length)
+_PIECE_LENGTH = 524288 #bytes 8-10GB else 262144?
 
-    if piece:
-        hash = hashlib.sha1(piece)
-        hashes.append(hash.digest())
+# Number of threads used to hash pieces. hashlib releases the GIL
+# while hashing, so pieces are hashed in parallel.
+HASH_WORKERS = os.cpu_count() or 1
+
+# Seconds between writes of the hash checkpoint
+CHECKPOINT_INTERVAL = 30
+
+# Pieces are hashed by a pool of workers, each reading into its own
+# fixed buffer. If given, progress is called after every piece with the
+# number of bytes done so far (hashed or known), the total number of
+# bytes and the hashing throughput in bytes per second. The known
+# pieces are reported once before hashing starts.
+#
+# known maps piece indexes to hashes which are already known, those
+# pieces are not read. save is called every CHECKPOINT_INTERVAL seconds
+# and when done, with the hash table so far and a bitfield of the
+# pieces it contains.
+def hash_file_pieces(file_list, length, workers = None, progress = None,\
+        known = None, save = None):
+    known = known or {}
+    sizes = [path.getsize(f) for f in file_list]
+    offsets = []
+    total = 0
+    for size in sizes:
+        offsets.append(total)
+        total += size
+
+    count = total // length + (1 if total % length else 0)
+    hashes = bytearray(20 * count)
+    buffers = threading.local()
+
+    def read_into(view, f, off):
+        with open(file_list[f], 'rb', buffering = 0) as fio:
+            fio.seek(off)
+            while view:
+                read = fio.readinto(view)
+                if not read:
+                    raise IOError("File %s changed while hashing" % \
+                                      file_list[f])
+                view = view[read:]
+
+    def hash_piece(index):
+        if not hasattr(buffers, 'view'):
+            buffers.view = memoryview(bytearray(length))
+
+        view = buffers.view
+        start = index * length
+        size = min(length, total - start)
+
+        f = bisect.bisect_right(offsets, start) - 1
+        read = 0
+        while read < size:
+            off = start + read - offsets[f]
+            need = min(sizes[f] - off, size - read)
+            if need > 0:
+                read_into(view[read:read + need], f, off)
+                read += need
+            f += 1
+
+        hashes[index * 20:index * 20 + 20] = \
+            hashlib.sha1(view[0:size]).digest()
+        return size
+
+    done = bitfield.Bitfield(count)
+    reused = 0
+    for index, digest in known.items():
+        if 0 <= index < count:
+            hashes[index * 20:index * 20 + 20] = digest
+            done.set(index)
+            reused += min(length, total - index * length)
+
+    workers = workers or HASH_WORKERS
+    started = time.time()
+    saved = started
+    hashed = reused
+
+    if progress and (reused or not total):
+        progress(hashed, total, 0)
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        # Keep a bounded number of pieces in flight
+        pending = collections.deque()
+        index = 0
+        while index < count or pending:
+            while index < count and len(pending) < 2 * workers:
+                if not done.get(index):
+                    pending.append((index, pool.submit(hash_piece, index)))
+                index += 1
+
+            if not pending:
+                break
+
+            piece, future = pending.popleft()
+            hashed += future.result()
+            done.set(piece)
+
+            now = time.time()
+            if progress:
+                elapsed = now - started
+                progress(hashed, total, \
+                             (hashed - reused) / elapsed if elapsed else 0)
+
+            if save and now - saved >= CHECKPOINT_INTERVAL:
+                save(hashes, done)
+                saved = now
+
+    if save:
+        save(hashes, done)
+
+    return bytes(hashes)
+
+# File table used to decide which pieces can be reused, a list of
+# (path components, size, modification time in ns) tuples
+def _file_table(file_list, paths):
+    table = []
+    for f, p in zip(file_list, paths):
+        stat = os.stat(f)
+        table.append((tuple(p), stat.st_size, stat.st_mtime_ns))
+
+    return table
+
+def _save_checkpoint(checkpoint, length, table, hashes, done):
+    content = {
+        'piece length': length,
+        'files': [{'path': list(p), 'length': size, 'mtime': mtime} \
+                      for p, size, mtime in table],
+        'pieces': hashes,
+        'hashed': done.pack()
+    }
 
-    return b''.join(hashes)
+    temp = checkpoint + '.tmp'
+    with open(temp, 'wb') as f:
+        bencoder.encode_to(content, f)
+    os.replace(temp, checkpoint)
+
+# Loads the piece length, file table and hashes from a hash checkpoint
+# or a .torrent file. A .torrent has no modification times, its files
+# are considered unchanged if they are not newer than the .torrent
+# itself.
+def _load_previous(previous):
+    with open(previous, 'rb') as f:
+        content = f.read()
+
+    try:
+        saved = schema.decode(content, _Checkpoint)
+        table = [(tuple(e.path), e.length, e.mtime) for e in saved.files]
+        count = len(saved.pieces) // 20
+        done = bitfield.unpack(saved.hashed, count)
+        return saved.piece_length, table, saved.pieces, done
+    except (BencodeError, ValueError):
+        pass
+
+    meta = Torrent(content)
+    mtime = os.stat(previous).st_mtime_ns
+    table = []
+    if meta.is_single_file:
+        table.append(((meta.name,), meta.length, mtime))
+    else:
+        for f in range(meta.number_of_files):
+            table.append((tuple(meta.file_path(f)), meta.file_size(f), mtime))
+
+    done = bitfield.Bitfield(meta.number_of_pieces)
+    for i in range(meta.number_of_pieces):
+        done.set(i)
+
+    return meta.piece_length, table, meta.pieces, done
+
+# Pieces of the previous hashing which cover exactly the same,
+# unchanged, file ranges in the new file table
+def _reusable_pieces(previous, length, table):
+    old_length, old_table, pieces, done = previous
+    if old_length != length:
+        return {}
+
+    old_files = {}
+    offset = 0
+    for p, size, mtime in old_table:
+        old_files[p] = (offset, size, mtime)
+        offset += size
+    old_total = offset
+
+    offsets = []
+    total = 0
+    for p, size, mtime in table:
+        offsets.append(total)
+        total += size
+
+    def unchanged(f, offset):
+        p, size, mtime = table[f]
+        old = old_files.get(p)
+        return not old is None and old[0] == offset and \
+            old[1] == size and mtime <= old[2]
+
+    known = {}
+    count = min(len(done), total // length + (1 if total % length else 0))
+    for index in range(count):
+        start = index * length
+        end = min(start + length, total)
+        if not done.get(index) or end != min(start + length, old_total):
+            continue
+
+        f = bisect.bisect_right(offsets, start) - 1
+        reuse = True
+        while f < len(table) and offsets[f] < end:
+            if table[f][1] and not unchanged(f, offsets[f]):
+                reuse = False
+                break
+            f += 1
+
+        if reuse:
+            known[index] = pieces[index * 20:index * 20 + 20]
+
+    return known
+
+# Hashes the pieces of the files, reusing the hashes of unchanged
+# pieces found in previous (a .torrent or hash checkpoint file) and
+# checkpoint. Progress is saved to checkpoint while hashing, so an
+# interrupted run can be resumed.
+def _hash_pieces(file_list, paths, length, workers, progress, \
+        previous, checkpoint):
+    table = _file_table(file_list, paths)
+
+    known = {}
+    for p in (previous, checkpoint):
+        if p and path.exists(p):
+            known.update(_reusable_pieces(_load_previous(p), length, table))
+
+    save = None
+    if checkpoint:
+        save = lambda hashes, done: \
+            _save_checkpoint(checkpoint, length, table, hashes, done)
+
+    return hash_file_pieces(file_list, length, workers, progress, \
+                                known, save)
+
+# If out is given the torrent is written to it (any object with a write
+# method) and nothing is returned, otherwise the content is returned
+def _encode(torrent, out):
+    if out is None:
+        return bencoder.encode(torrent)
+
+    bencoder.encode_to(torrent, out)
 
 def dir_to_torrent(dir_path, announce, announce_list = None,\
-        piece_length = _PIECE_LENGTH, comment = None, is_private = False):
+        piece_length = _PIECE_LENGTH, comment = None, is_private = False,\
+        out = None, workers = None, progress = None, previous = None,\
+        checkpoint = None):
     if dir_path.endswith(os.sep):
         dir_path = dir_path[0:-1]
 
@@ -70,8 +305,9 @@ def dir_to_torrent(dir_path, announce, announce_list = None,\
     info = {
         'piece length': piece_length,
         'name': dir_name,
-        'pieces': hash_file_pieces(\
-            [path.join(dir_path, *p) for p in paths], piece_length)
+        'pieces': _hash_pieces(\
+            [path.join(dir_path, *p) for p in paths], paths, piece_length,\
+                workers, progress, previous, checkpoint)
     }
 
     if is_private:
@@ -86,10 +322,12 @@ def dir_to_torrent(dir_path, announce, announce_list = None,\
 
     info['files'] = files
     torrent['info'] = info
-    return bencoder.encode(torrent)
+    return _encode(torrent, out)
 
 def file_to_torrent(file_path, announce, announce_list = None,\
-        piece_length = _PIECE_LENGTH, comment = None, is_private = False):
+        piece_length = _PIECE_LENGTH, comment = None, is_private = False,\
+        out = None, workers = None, progress = None, previous = None,\
+        checkpoint = None):
     torrent = {
         'creation date': round(time.time()),
         'announce': announce
@@ -110,19 +348,179 @@ def file_to_torrent(file_path, announce, announce_list = None,\
     if is_private:
         torrent['private'] = 1
 
-    pieces = hash_file_pieces([file_path], piece_length)
+    pieces = _hash_pieces([file_path], [[path.basename(file_path)]], \
+        piece_length, workers, progress, previous, checkpoint)
     info['pieces'] = pieces
     torrent['info'] = info
-    return bencoder.encode(torrent)
+    return _encode(torrent, out)
 
 def to_torrent(ospath, announce, announce_list = None,\
-        piece_length = _PIECE_LENGTH, comment = None, is_private = False):
+        piece_length = _PIECE_LENGTH, comment = None, is_private = False,\
+        out = None, workers = None, progress = None, previous = None,\
+        checkpoint = None):
     if path.isfile(ospath):
         return file_to_torrent(ospath, announce, announce_list,\
-                                   piece_length, comment, is_private)
+            piece_length, comment, is_private, out, workers, progress,\
+            previous, checkpoint)
     else:
         return dir_to_torrent(ospath, announce, announce_list,\
-                                   piece_length, comment, is_private)
+            piece_length, comment, is_private, out, workers, progress,\
+            previous, checkpoint)
+
+
+# Lengths and attributes of the files in a files list (a lazy.LazyList
+# of file dictionaries), read from its index without decoding the
+# entries. Paths are left in the encoded list until they are asked
+# for, see _FilePaths.
+def _file_entries(files):
+    if not isinstance(files, lazy.LazyList):
+        raise BencodeError("Invalid files list")
+
+    index = files.index
+    children, kind, key_of, value_of, span = index.children, index.kind, \
+        index.key, index.value, index.span
+    lengths = array.array('q')
+    attrs = []
+    # Start and end of the encoded path of every file
+    paths = array.array('q')
+
+    for entry in children(files.token):
+        if kind(entry) != lazy.DICTIONARY:
+            raise BencodeError("Invalid file entry")
+
+        length, path, attr = None, None, b''
+        keys = children(entry)
+        for key in keys:
+            value = next(keys)
+            name = key_of(key)
+            if name == b'length' and kind(value) == lazy.INTEGER:
+                length = value_of(value)
+            elif name == b'path' and kind(value) == lazy.LIST:
+                path = span(value)
+            elif name == b'attr' and kind(value) == lazy.STRING:
+                attr = value_of(value)
+
+        if length is None or path is None:
+            raise BencodeError("Invalid file entry")
+
+        lengths.append(length)
+        attrs.append(attr.decode('UTF-8', 'replace'))
+        paths.extend(path)
+
+    return _FilePaths(index.string, paths), lengths, attrs
+
+# Paths of the files of a torrent, decoded from the encoded files list
+# only when asked for
+class _FilePaths(object):
+    def __init__(self, encoded, spans):
+        self._encoded = encoded
+        self._spans = spans
+
+    def __len__(self):
+        return len(self._spans) // 2
+
+    def __getitem__(self, f):
+        if not 0 <= f < len(self):
+            raise IndexError("No file %d" % f)
+
+        # The list was checked when it was scanned, only the kind of
+        # its items is left to check
+        encoded = self._encoded
+        index = self._spans[2 * f] + 1
+        end = self._spans[2 * f + 1] - 1
+        parts = []
+        try:
+            while index < end:
+                colon = encoded.index(b':', index, end)
+                index = colon + 1 + int(encoded[index:colon])
+                parts.append(encoded[colon + 1:index].decode('UTF-8'))
+        except (ValueError, UnicodeDecodeError):
+            raise BencodeError("Invalid path of file %d" % f)
+
+        return tuple(parts)
+
+    def __iter__(self):
+        for f in range(len(self)):
+            yield self[f]
+
+class _Info(schema.Record):
+    fields = (
+        schema.Field('piece length', int),
+        schema.Field('pieces', bytes, None),
+        schema.Field('name', str),
+        schema.Field('length', int, None),
+        schema.Field('files', schema.LAZY, None),
+        schema.Field('meta version', int, 1),
+        schema.Field('file tree', schema.ANY, None)
+    )
+
+class _Metainfo(schema.Record):
+    fields = (
+        schema.Field('announce', str),
+        schema.Field('announce-list', schema.List(schema.List(str)), None),
+        schema.Field('info', _Info),
+        schema.Field('piece layers', schema.ANY, None)
+    )
+
+# Files of a BitTorrent v2 file tree, in order, as a list of (path,
+# length, pieces root) tuples
+def _file_tree(tree, path = []):
+    files = []
+    for name in sorted(tree):
+        node = tree[name]
+        if not isinstance(node, dict):
+            raise BencodeError("Invalid file tree")
+
+        if name == b'':
+            root = node.get(b'pieces root', None)
+            files.append((path, node[b'length'], root))
+        else:
+            files += _file_tree(node, path + [name.decode('UTF-8')])
+
+    return files
+
+# BitTorrent v2 pieces never span files. Files are laid out as in a
+# hybrid torrent, with a padding file after every file not ending on a
+# piece boundary.
+def _v2_layout(files, piece_length):
+    paths, lengths, attrs, roots = [], [], [], []
+    for i, (path, length, root) in enumerate(files):
+        paths.append(path)
+        lengths.append(length)
+        attrs.append('')
+        roots.append(root)
+
+        pad = -length % piece_length
+        if pad and i < len(files) - 1:
+            paths.append(['.pad', str(pad)])
+            lengths.append(pad)
+            attrs.append('p')
+            roots.append(None)
+
+    return paths, lengths, attrs, roots
+
+# Where the hashes of a piece are found in the merkle tree of its file.
+# The piece covers leaf_count leaves (16 KiB blocks) starting at
+# leaf_index, of which the first length bytes are file data. The root
+# of those leaves must be expected.
+MerklePiece = collections.namedtuple('MerklePiece', \
+    ['pieces_root', 'leaf_index', 'leaf_count', 'expected', 'length'])
+
+
+class _CheckpointEntry(schema.Record):
+    fields = (
+        schema.Field('path', schema.List(str)),
+        schema.Field('length', int),
+        schema.Field('mtime', int)
+    )
+
+class _Checkpoint(schema.Record):
+    fields = (
+        schema.Field('piece length', int),
+        schema.Field('files', schema.List(_CheckpointEntry)),
+        schema.Field('pieces', bytes),
+        schema.Field('hashed', bytes)
+    )
 
 
 class Torrent(object):
@@ -137,56 +535,155 @@ class Torrent(object):
     def __init__(self, content):
         self._load_torrent(content)
 
+    # Creates a torrent from already parsed metadata, without any
+    # bencode decoding. pieces can be any bytes-like object.
+    @classmethod
+    def from_metadata(cls, info_hash, announce, announce_list, name, \
+                          piece_length, pieces, paths, lengths, single, \
+                          attrs = None):
+        torrent = cls.__new__(cls)
+        torrent._set_metadata(info_hash, announce, announce_list, name, \
+                                  piece_length, pieces, paths, lengths, single, \
+                                  attrs)
+        return torrent
+
     def _load_torrent(self, content):
         #f = open(path, 'rb')
         #content = f.read()
         #f.close()
 
-        parsed = bdecoder.decode(content)
-        info_hash = hashlib.sha1(bdecoder.decode(content, 2)[b'info'])
-        self._hex_info_hash = info_hash.hexdigest()
-        self._info_hash = info_hash.digest()
-        
-        self._announce = parsed[b'announce'].decode('UTF-8')
-
-        if b'announce-list' in parsed:
-            announce_list = parsed[b'announce-list']
-            self._announce_list = []
-            for tire in announce_list:
-                self._announce_list.append(\
-                    [announce.decode('UTF-8') for announce in tire])
+        # Only the keys used below are decoded, the info hash is
+        # computed from the original bytes of the info dictionary
+        parsed = schema.decode(content, _Metainfo)
+        start, end = parsed.info.span
+        raw_info = memoryview(content)[start:end]
+
+        info = parsed.info
+        tree = None
+        if info.meta_version == 2:
+            if not isinstance(info.file_tree, dict):
+                raise BencodeError("Missing file tree in v2 torrent")
+            tree = _file_tree(info.file_tree)
+
+        attrs = None
+        roots = None
+        if not info.pieces is None:
+            # BitTorrent v1 or hybrid torrent
+            info_hash = hashlib.sha1(raw_info).digest()
+
+            if not info.files is None:
+                single = False
+                paths, lengths, attrs = _file_entries(info.files)
+            elif not info.length is None:
+                single = True
+                paths = [[info.name]]
+                lengths = [info.length]
+            else:
+                raise BencodeError(\
+                    "Info dictionary has neither files nor length")
+
+            if not tree is None:
+                by_path = dict((tuple(p), r) for p, l, r in tree)
+                roots = [by_path.get(tuple(p), None) for p in paths]
+        elif not tree is None:
+            # BitTorrent v2 only, peers use the truncated v2 info hash
+            info_hash = hashlib.sha256(raw_info).digest()[0:20]
+            paths, lengths, attrs, roots = \
+                _v2_layout(tree, info.piece_length)
+            single = len(tree) == 1 and tree[0][0] == [info.name]
         else:
-            self._announce_list = None
-
-        info = parsed[b'info']
-        self._piece_length = info[b'piece length']
-
-        pieces = info[b'pieces']
-        self._pieces = []
+            raise BencodeError("Info dictionary has no pieces")
+
+        self._set_metadata(info_hash, parsed.announce, parsed.announce_list, \
+                               info.name, info.piece_length, info.pieces, \
+                               paths, lengths, single, attrs)
+
+        if not tree is None:
+            self._set_v2(hashlib.sha256(raw_info).digest(), roots, \
+                             parsed.piece_layers or {}, \
+                             not info.pieces is None)
+
+    def _set_metadata(self, info_hash, announce, announce_list, name, \
+                          piece_length, pieces, paths, lengths, single, \
+                          attrs = None):
+        self._info_hash = bytes(info_hash)
+        self._hex_info_hash = self._info_hash.hex()
         
-        current = 0
-        length = len(pieces)
-        while current < length:
-            self._pieces.append(pieces[current:current + 20])
-            current += 20
+        self._announce = announce
+        self._announce_list = announce_list
 
-        self._name = info[b'name'].decode('UTF-8')
-        
-        if b'files' in info:
-            self._files = info[b'files']
-            self._mode = 'multiple'
+        self._piece_length = piece_length
 
-            self._length = 0
-            for f in self._files:
-                self._length += f[b'length']
-        else:
-            self._length = info[b'length']
-            self._mode = 'single'
+        # All piece hashes are kept in one buffer
+        self._pieces = pieces
+        self._pieces_view = None if pieces is None else memoryview(pieces)
+
+        self._name = name
+        self._mode = 'single' if single else 'multiple'
+        self._index_files(paths, lengths, attrs)
 
         self._nb_of_pieces = self._length // self._piece_length
         if self._length % self._piece_length != 0:
             self._nb_of_pieces += 1
 
+        if not pieces is None and \
+                len(self._pieces_view) != 20 * self._nb_of_pieces:
+            raise BencodeError("Expected %d piece hashes, got %d bytes" % \
+                                   (self._nb_of_pieces, len(self._pieces)))
+
+        self._info_hash_v2 = None
+        self._hybrid = False
+        self._file_roots = None
+        self._piece_layers = None
+
+    def _set_v2(self, info_hash_v2, roots, piece_layers, hybrid):
+        if self._piece_length < merkle.BLOCK_SIZE or \
+                self._piece_length & (self._piece_length - 1):
+            raise BencodeError("Piece length must be a power of two " + \
+                                   "of at least 16 KiB in v2 torrents")
+
+        self._info_hash_v2 = info_hash_v2
+        self._hybrid = hybrid
+        self._file_roots = tuple(roots)
+        self._piece_layers = piece_layers
+
+        # The piece layers must hash up to the pieces roots
+        height = merkle.piece_height(self._piece_length)
+        for f, root in enumerate(self._file_roots):
+            size = self._file_lengths[f]
+            if root is None or size <= self._piece_length:
+                continue
+
+            layer = piece_layers.get(root, None)
+            count = -(-size // self._piece_length)
+            if layer is None or len(layer) != merkle.HASH_SIZE * count:
+                raise BencodeError("Missing piece layer for file " + \
+                                       '/'.join(self._file_paths[f]))
+
+            hashes = merkle.split(layer)
+            if merkle.root(hashes, None, height) != root:
+                raise BencodeError("Invalid piece layer for file " + \
+                                       '/'.join(self._file_paths[f]))
+
+    # File lengths and start offsets are kept in arrays, and paths as
+    # tuples of interned strings, or in the files list they are decoded
+    # from when needed
+    def _index_files(self, paths, lengths, attrs = None):
+        self._file_attrs = None if attrs is None or not any(attrs) \
+            else tuple(attrs)
+        if isinstance(paths, _FilePaths):
+            self._file_paths = paths
+        else:
+            self._file_paths = tuple(tuple(sys.intern(p) for p in path) \
+                                         for path in paths)
+        self._file_lengths = array.array('q', lengths)
+        self._file_offsets = array.array('q')
+
+        self._length = 0
+        for length in lengths:
+            self._file_offsets.append(self._length)
+            self._length += length
+
     @property
     def hex_info_hash(self):
         return self._hex_info_hash
@@ -195,6 +692,7 @@ class Torrent(object):
     def info_hash(self):
         return self._info_hash
             
+    # Piece hashes concatenated in one bytes object
     @property
     def pieces(self):
         return self._pieces
@@ -211,9 +709,10 @@ class Torrent(object):
     def piece_length(self):
         return self._piece_length
 
+    # List of (path, length) tuples
     @property
     def files(self):
-        return self._files
+        return list(zip(self._file_paths, self._file_lengths))
 
     @property
     def length(self):
@@ -231,28 +730,108 @@ class Torrent(object):
     def number_of_pieces(self):
         return self._nb_of_pieces
 
+    # 1 for BitTorrent v1 torrents, 2 for v2 and hybrid torrents
+    @property
+    def version(self):
+        return 1 if self._info_hash_v2 is None else 2
+
+    @property
+    def is_hybrid(self):
+        return self._hybrid
+
+    # SHA-256 of the info dictionary, None for v1 torrents
+    @property
+    def info_hash_v2(self):
+        return self._info_hash_v2
+
     @property
     def number_of_files(self):
-        if self.is_single_file:
-            return 1
-        else:
-            return len(self._files)
+        return len(self._file_lengths)
 
     def file_path(self, f):
         if self.is_single_file and f == 0:
             return self._name
         else:
-            path = self._files[f][b'path']
-            return [p.decode('UTF-8') for p in path]
+            return self._file_paths[f]
 
     def file_size(self, f):
-        if self.is_single_file and f == 0:
-            return self._length
-        else:
-            return self._files[f][b'length']
+        return self._file_lengths[f]
+
+    # Offset of the first byte of the file within the torrent
+    def file_offset(self, f):
+        return self._file_offsets[f]
+
+    # BEP 47 attribute string of the file, empty if it has none
+    def file_attrs(self, f):
+        return '' if self._file_attrs is None else self._file_attrs[f]
+
+    # Padding files only contain zeros and are never stored
+    def is_pad_file(self, f):
+        return not self._file_attrs is None and 'p' in self._file_attrs[f]
+
+    def file_pieces_root(self, f):
+        if self._file_roots is None:
+            return None
+
+        return self._file_roots[f]
 
+    def piece_layer(self, pieces_root):
+        if self._piece_layers is None:
+            return None
+
+        return self._piece_layers.get(pieces_root, None)
+
+    # MerklePiece for the piece, or None for v1 torrents
+    def piece_merkle(self, piece):
+        if self._file_roots is None:
+            return None
+
+        f, off, length = self.piece_spans(piece)[0]
+        root = self._file_roots[f]
+        if root is None:
+            return None
+
+        size = self._file_lengths[f]
+        blocks = self._piece_length // merkle.BLOCK_SIZE
+        if size <= self._piece_length:
+            count = merkle.next_power_of_two(-(-size // merkle.BLOCK_SIZE))
+            return MerklePiece(root, 0, count, root, size)
+
+        index = off // self._piece_length
+        expected = self._piece_layers[root][\
+            merkle.HASH_SIZE * index:merkle.HASH_SIZE * (index + 1)]
+        return MerklePiece(root, index * blocks, blocks, expected, \
+                               min(self._piece_length, size - off))
+
+    # SHA1 of the piece, None for v2 only torrents
     def piece_hash(self, piece):
-        return self._pieces[piece]
+        if not 0 <= piece < self._nb_of_pieces:
+            raise IndexError("Piece " + str(piece) + " is not valid")
+
+        if self._pieces_view is None:
+            return None
+
+        return self._pieces_view[20 * piece:20 * piece + 20]
+
+    # The parts of files covered by the piece, as a list of
+    # (file, offset in file, length) tuples
+    def piece_spans(self, piece):
+        start = self._piece_length * piece
+        remaining = self.piece_size(piece)
+        f = bisect.bisect_right(self._file_offsets, start) - 1
+        off = start - self._file_offsets[f]
+
+        spans = []
+        while remaining > 0:
+            length = min(self._file_lengths[f] - off, remaining)
+            if length > 0:
+                spans.append((f, off, length))
+                remaining -= length
+
+            f += 1
+            off = 0
+
+        return spans
 
     def piece_size(self, piece):
         if piece == self._nb_of_pieces - 1:
@@ -262,14 +841,49 @@ class Torrent(object):
         else:
             raise IndexError("Piece " + str(piece) + " is not valid")
 
+# Time and memory taken to load a torrent of many files, and to decode
+# all the paths afterwards (as creating its storage does)
+def _load_benchmark(number_of_files = 100000, rounds = 3):
+    import tracemalloc
+
+    files = [{'length': 1000 + i, 'path': ['dir%03d' % (i // 1000), \
+                'sub%02d' % (i % 37), 'file-%06d.bin' % i]} \
+                 for i in range(number_of_files)]
+    pieces = (sum(f['length'] for f in files) + 262143) // 262144
+    content = bencoder.encode({'announce': 'http://tracker/announce', \
+        'info': {'name': 'many', 'piece length': 262144, \
+                     'pieces': bytes(20 * pieces), 'files': files}})
+
+    best = None
+    for i in range(rounds):
+        start = time.perf_counter()
+        Torrent(content)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    torrent = Torrent(content)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for f in range(torrent.number_of_files):
+        torrent.file_path(f)
+    paths = time.perf_counter() - start
+
+    print("%d files, %.1f MiB" % (number_of_files, len(content) / 2 ** 20))
+    print(" - load      %.3f s" % best)
+    print(" - peak      %.1f MiB" % (peak / 2 ** 20))
+    print(" - retained  %.1f MiB" % (retained / 2 ** 20))
+    print(" - all paths %.3f s" % paths)
+
 if __name__ == '__main__':
-    import sys
-    
     def usage():
         print("Generate content of .torrent file from given" +\
                   " directory or file")
         print("Usage: python torrent.py <path> <announce> " +\
-                  "[--piece-length <length>] [--comment <comment>] [--out <file>]")
+                  "[--piece-length <length>] [--comment <comment>] [--out <file>]" +\
+                  " [--workers <n>] [--previous <file>] [--checkpoint <file>]")
         print("  <path>        \t Path to file or directory")
         print("  <announce>    \t One or more tracker urls")
         print("                \t Multiple urls can be grouped into tires with quotes \"\"")
@@ -278,6 +892,12 @@ if __name__ == '__main__':
         print("  --comment     \t Comment to be included in the torrent")
         print("  --out         \t Output file for the torrent content")
         print("                \t (default stdin)")
+        print("  --workers     \t Number of threads hashing pieces")
+        print("                \t (default number of CPUs)")
+        print("  --previous    \t Earlier .torrent or checkpoint of the same")
+        print("                \t files, unchanged pieces are not rehashed")
+        print("  --checkpoint  \t File where hashing progress is saved,")
+        print("                \t resumes from it if it exists")
         print()
         print("Example: python torrent.py move.avi http://opentracker:8080/announce")
         print("         python torrent.py music \"http://opentracker/announce http://piratetracker:7005/announce\" http://tracker/announce")
@@ -285,7 +905,10 @@ if __name__ == '__main__':
     options = {
         '--piece-length': 'piece_length',
         '--comment': 'comment',
-        '--out': 'out'
+        '--out': 'out',
+        '--workers': 'workers',
+        '--previous': 'previous',
+        '--checkpoint': 'checkpoint'
     }
 
     arguments = {
@@ -329,6 +952,15 @@ if __name__ == '__main__':
         elif opt == '--out':
             i += 1
             out = sys.argv[i]
+        elif opt == '--workers':
+            i += 1
+            arguments['workers'] = int(sys.argv[i])
+        elif opt == '--previous':
+            i += 1
+            arguments['previous'] = sys.argv[i]
+        elif opt == '--checkpoint':
+            i += 1
+            arguments['checkpoint'] = sys.argv[i]
         else:
             print(" - Uknown option '" + opt + "'")
             usage()
@@ -343,10 +975,17 @@ if __name__ == '__main__':
     if out:
         print(' -out: ' + out)
 
-    content = to_torrent(**arguments)
+    def progress(hashed, total, rate):
+        sys.stderr.write("\rHashed %d/%d MB (%.1f MB/s)" % \
+            (hashed // 1048576, total // 1048576, rate / 1048576))
+        if hashed == total:
+            sys.stderr.write("\n")
+
+    arguments['progress'] = progress
+
     if out:
         print("Writing to '" + out + "'...")
         with open(out, 'wb') as f:
-            f.write(content)
+            to_torrent(out = f, **arguments)
     else:
-        print(content)
+        print(to_torrent(**arguments))
@@ -0,0 +1,224 @@
+import io
+import logging
+
+import storage
+
+_logger = logging.getLogger('bittorrent.torrentfile')
+
+# Index of the file at path (a str with / separators or a sequence of
+# parts). Paths are those of torrent.files, the file of a single file
+# torrent is its name.
+def _file_index(torrent, path):
+    if isinstance(path, str):
+        path = tuple(path.split('/'))
+
+    for f, (parts, length) in enumerate(torrent.files):
+        if tuple(parts) == tuple(path):
+            return f
+
+    raise ValueError("No file %s in the torrent" % '/'.join(path))
+
+# A file of a torrent being downloaded, read like a regular (binary,
+# read-only) file. Reads are mapped onto the pieces of the file and
+# block until the pieces needed have been downloaded and verified, or
+# for at most timeout seconds (then TimeoutError is raised). Files are
+# opened with PeerManager.open_file.
+#
+# The manager streams the torrent from the position of the file (see
+# manager.Stream): the pieces being read and the ones after them, up
+# to window pieces, are downloaded first, and the pieces a read waits
+# for get the highest priority until they arrive or the reader moves
+# on. A skipped file is no longer skipped once it is opened.
+class TorrentFile(io.RawIOBase):
+    def __init__(self, manager, f, window = None, rate = None, \
+                     timeout = None):
+        super(TorrentFile, self).__init__()
+
+        self._manager = manager
+        self._storage = manager.storage
+        self._torrent = manager.torrent
+        self._timeout = timeout
+
+        if not isinstance(f, int):
+            f = _file_index(self._torrent, f)
+
+        self._file = f
+        self._start = self._torrent.file_offset(f)
+        self._size = self._torrent.file_size(f)
+        self._position = 0
+        # Set by seek, the stream is moved to the next read
+        self._seeked = False
+        # Piece index => own priority it had before the read waited
+        self._raised = {}
+
+        if self._storage.file_priority(f) == storage.PRIORITY_SKIP:
+            manager.set_file_priority(f, storage.PRIORITY_NORMAL)
+
+        stream = {}
+        if not window is None:
+            stream['window'] = window
+        if not rate is None:
+            stream['rate'] = rate
+        self._stream = manager.start_streaming(self._start, **stream)
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def stream(self):
+        return self._stream
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._size + offset
+        else:
+            raise ValueError("Invalid whence (%s)" % whence)
+
+        if position < 0:
+            raise ValueError("Negative seek position %d" % position)
+
+        if position != self._position:
+            self._position = position
+            self._seeked = True
+        return position
+
+    def readinto(self, buffer):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+
+        view = memoryview(buffer).cast('B')
+        length = min(len(view), self._size - self._position)
+        if length <= 0:
+            return 0
+
+        start = self._start + self._position
+        piece_length = self._torrent.piece_length
+        first = start // piece_length
+        last = (start + length - 1) // piece_length
+
+        self._follow(first)
+        self._wait(range(first, last + 1))
+
+        done = 0
+        for index in range(first, last + 1):
+            offset = start + done - index * piece_length
+            size = min(length - done, \
+                           self._torrent.piece_size(index) - offset)
+            view[done:done + size] = \
+                self._storage.read_block(index, offset, size)
+            done += size
+
+        self._position += length
+        return length
+
+    # Moves the cursor of the stream to the piece being read: seeks it
+    # after seek, and advances it along a sequential read, which keeps
+    # the timing of the stream (see manager.Stream)
+    def _follow(self, index):
+        seeked, self._seeked = self._seeked, False
+        if not self._manager.stream is self._stream:
+            return
+
+        if seeked:
+            self._manager.seek(index * self._torrent.piece_length)
+        elif self._stream.cursor != index:
+            self._manager.advance(index * self._torrent.piece_length)
+
+    def _wait(self, pieces):
+        missing = [i for i in pieces if not self._storage.has(i)]
+
+        # Pieces raised before which arrived or which the reader left
+        # get their priority back, in one update with the new ones
+        changes = dict((i, p) for i, p in self._raised.items() \
+                           if not i in missing)
+        for index in changes:
+            del self._raised[index]
+
+        for index in missing:
+            if not index in self._raised and \
+                    self._storage.piece_priority(index) < \
+                    storage.PRIORITY_HIGH:
+                self._raised[index] = self._storage.own_piece_priority(index)
+                changes[index] = storage.PRIORITY_HIGH
+
+        if changes:
+            self._manager.set_piece_priorities(changes)
+
+        for index in missing:
+            if not self._manager.wait_for_piece(index, self._timeout):
+                raise TimeoutError("Piece %d not downloaded in time" % index)
+
+    def close(self):
+        if not self.closed:
+            if self._raised:
+                self._manager.set_piece_priorities(self._raised)
+                self._raised = {}
+
+            if self._manager.stream is self._stream:
+                self._manager.stop_streaming()
+
+        super(TorrentFile, self).close()
+
+
+def _check():
+    import torrent
+
+    single = torrent.Torrent.from_metadata(bytes(20), 'http://tracker', \
+        None, 'movie.avi', 16384, bytes(20), [['movie.avi']], [100], True)
+    assert _file_index(single, 'movie.avi') == 0
+    assert _file_index(single, ['movie.avi']) == 0
+
+    multiple = torrent.Torrent.from_metadata(bytes(20), 'http://tracker', \
+        None, 'dir', 16384, bytes(20), [['a'], ['sub', 'b']], [100, 100], \
+        False)
+    assert _file_index(multiple, 'sub/b') == 1
+    assert _file_index(multiple, ('a',)) == 0
+
+    for t, path in ((single, 'other.avi'), (multiple, 'b')):
+        try:
+            _file_index(t, path)
+            assert False, path
+        except ValueError:
+            pass
+
+    print("File lookup checks passed")
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import main
+
+    # Without a torrent only the file lookup is checked
+    if len(sys.argv) < 2:
+        _check()
+        sys.exit()
+
+    main.setup_logger()
+    client = main.Client()
+    man = client.start(sys.argv[1])
+
+    with man.open_file(int(sys.argv[2]) if len(sys.argv) > 2 else 0) as f:
+        start = time.time()
+        data = f.read(16384)
+        print("First %d bytes after %.2f s" % (len(data), time.time() - start))
+
+        while data:
+            data = f.read(1024 * 1024)
+
+        print(f.stream.statistics())
+
+    client.halt()
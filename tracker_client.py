@@ -7,7 +7,7 @@ import logging
 import time
 
 import utils
-import bencode.bdecoder as bdecoder
+import bencode.schema as schema
 from bencode.bencode_error import BencodeError
 
 NUMWANT = 30
@@ -163,6 +163,23 @@ class AsyncTrackerManager(TrackerManager):
     def halt(self):
         self._worker.halt()
 
+    # Stops the worker thread, announces due while hibernating are left
+    # to whoever calls wake (see next_announce)
+    def hibernate(self):
+        self._worker.halt()
+        self._waiting = False
+
+    def wake(self):
+        self._worker = utils.TimerTask()
+        self._worker.start()
+
+    # Time of the next announce we have been asked for, None if no
+    # tracker has replied yet
+    def next_announce(self):
+        times = [t.next_contact for t in self.trackers() \
+                     if not t.next_contact is None]
+        return min(times) if times else None
+
     def request(self, numwant = NUMWANT, force = False):
         if self._waiting:
             return
@@ -276,6 +293,18 @@ class TrackerClient(object):
         return tracker_response
 
 
+class _Reply(schema.Record):
+    fields = (
+        schema.Field('failure reason', str, None),
+        schema.Field('interval', int, None),
+        schema.Field('min interval', int, 0),
+        schema.Field('tracker id', bytes, None),
+        schema.Field('complete', int, None),
+        schema.Field('incomplete', int, None),
+        schema.Field('peers', schema.ANY, None)
+    )
+
+
 class TrackerResponse(object):
     def __init__(self, response, tracker):
         self._tracker = tracker
@@ -284,23 +313,27 @@ class TrackerResponse(object):
     def _parse_response(self, resp):
         parsed = None
         try:
-            parsed = bdecoder.decode(resp)
+            parsed = schema.decode(resp, _Reply)
         except BencodeError as err:
             raise TrackerResponseError("Response parsing failed. %s" % err)
 
-        if b'failure reason' in parsed:
+        if not parsed.failure_reason is None:
             _logger.info("Tracker %s failure, with %s" %\
-                             (self._tracker.announce, parsed[b'failure']))
-            raise TrackerResponseError(\
-                parsed[b'failure reason'].decode('UTF-8'))
-
-        self._interval = parsed[b'interval']
-        self._min_interval = parsed.get(b'min interval', 0)
-        self._tracker_id = parsed.get(b'tracker id', None)
-        self._complete = parsed[b'complete']
-        self._incomplete = parsed[b'incomplete']
+                             (self._tracker.announce, parsed.failure_reason))
+            raise TrackerResponseError(parsed.failure_reason)
+
+        for name in ('interval', 'complete', 'incomplete', 'peers'):
+            if getattr(parsed, name) is None:
+                raise TrackerResponseError(\
+                    "Response is missing %s" % name.replace('_', ' '))
+
+        self._interval = parsed.interval
+        self._min_interval = parsed.min_interval
+        self._tracker_id = parsed.tracker_id
+        self._complete = parsed.complete
+        self._incomplete = parsed.incomplete
         
-        peers = parsed[b'peers']
+        peers = parsed.peers
         if isinstance(peers, list):
             self._peers = peers
         else:
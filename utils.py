@@ -147,6 +147,38 @@ class TimerTask(threading.Thread):
         def __call__(self):
             return self._f(*self._args, **self._kwargs)
 
+# Token bucket limiting a rate (e.g. bytes per second). consume blocks
+# until the tokens are available. Bursts of up to burst tokens (one
+# second worth by default) are let through at once.
+class TokenBucket(object):
+    def __init__(self, rate, burst = None):
+        self._rate = float(rate)
+        self._burst = float(burst or rate)
+        self._tokens = self._burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    def _fill(self):
+        now = time.monotonic()
+        self._tokens = min(self._burst, \
+                               self._tokens + (now - self._last) * self._rate)
+        self._last = now
+
+    def consume(self, tokens):
+        with self._lock:
+            self._fill()
+            # Requests larger than the bucket are let through once it is
+            # full, leaving it in debt
+            self._tokens -= tokens
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
 
 if __name__ == '__main__':
     #t1 = TimerTask.Task(1, lambda x: x)